@@ -0,0 +1,204 @@
+import mmap
+import json
+import os
+import struct
+from platform import system
+from util import log, Singleton
+
+
+RECORD_HEADER = struct.Struct('<64s64sI')  # public key, hash, length of data. Zero length - avatar was removed
+
+COMPACTION_MIN_GARBAGE = 1024 * 1024  # data file is compacted if it has more bytes of outdated records
+
+
+class AvatarStore(Singleton):
+    """
+    Packed append-only storage of avatars. All avatars are saved in one data file as records (header, data).
+    Index (public key -> offset, length, hash) is saved to separate file on close. Records appended after
+    index was saved are read on start. Data file is read using mmap and is compacted when more than half of it
+    contains outdated records
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: path to directory with data and index files
+        """
+        self._data_path = directory + 'avatars.pack'
+        self._index_path = directory + 'avatars.idx'
+        self._index = {}  # key - public key, value - list [offset of data, length of data, hash]
+        self._map = None
+        if not os.path.isfile(self._data_path):
+            if os.path.isfile(self._data_path + '.bak'):  # compaction was interrupted while data file was replaced
+                os.rename(self._data_path + '.bak', self._data_path)
+            else:
+                open(self._data_path, 'wb').close()
+        self._file = open(self._data_path, 'r+b')
+        self._size = os.path.getsize(self._data_path)
+        self._live = 0  # total size of actual records
+        self._dirty = False  # index was changed after it was saved
+        self.load_index()
+        self.compact()
+
+    def __contains__(self, public_key):
+        return public_key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Reading
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get(self, public_key):
+        """
+        :param public_key: public key of contact
+        :return: avatar data (string) or None if contact has no avatar
+        """
+        entry = self._index.get(public_key)
+        if entry is None:
+            return None
+        if self._map is None:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[entry[0]:entry[0] + entry[1]]
+
+    def get_hash(self, public_key):
+        """
+        :param public_key: public key of contact
+        :return: hash of avatar or None if contact has no avatar
+        """
+        entry = self._index.get(public_key)
+        return entry[2] if entry is not None else None
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Writing
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def set(self, public_key, data, data_hash):
+        """
+        Save new avatar of contact
+        :param public_key: public key of contact
+        :param data: avatar data (string), can't be empty
+        :param data_hash: hash of avatar
+        """
+        self.append(public_key, data, data_hash)
+        self.compact()
+
+    def remove(self, public_key):
+        """
+        Remove avatar of contact
+        :param public_key: public key of contact
+        """
+        if public_key in self._index:
+            self.append(public_key, '', '')
+            self.compact()
+
+    def append(self, public_key, data, data_hash):
+        self.close_map()
+        self._file.seek(self._size)
+        self._file.write(RECORD_HEADER.pack(str(public_key), str(data_hash), len(data)) + data)
+        self._file.flush()
+        self.apply(public_key, self._size + RECORD_HEADER.size, len(data), data_hash)
+        self._size += RECORD_HEADER.size + len(data)
+
+    def apply(self, public_key, offset, length, data_hash):
+        """
+        Update index with new record
+        """
+        if public_key in self._index:
+            self._live -= RECORD_HEADER.size + self._index.pop(public_key)[1]
+        if length:
+            self._index[public_key] = [offset, length, data_hash]
+            self._live += RECORD_HEADER.size + length
+        self._dirty = True
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Index and compaction
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def load_index(self):
+        """
+        Load saved index and read records which were appended after it was saved
+        """
+        position = 0
+        if os.path.isfile(self._index_path):
+            try:
+                with open(self._index_path) as fl:
+                    data = json.loads(fl.read())
+                if data['size'] <= self._size:
+                    self._index = dict((str(key), value) for key, value in data['index'].items())
+                    position = data['size']
+            except Exception as ex:
+                log('Avatars index is broken: ' + str(ex))
+        self._live = sum(RECORD_HEADER.size + entry[1] for entry in self._index.values())
+        self._file.seek(position)
+        while position + RECORD_HEADER.size <= self._size:
+            public_key, data_hash, length = RECORD_HEADER.unpack(self._file.read(RECORD_HEADER.size))
+            if position + RECORD_HEADER.size + length > self._size:  # record wasn't saved completely
+                break
+            self.apply(public_key, position + RECORD_HEADER.size, length, data_hash.rstrip('\0'))
+            position += RECORD_HEADER.size + length
+            self._file.seek(position)
+        if position < self._size:
+            self._file.truncate(position)
+            self._size = position
+            self._dirty = True
+
+    def save_index(self):
+        """
+        Save index if it was changed. Called on close and after compaction, not after each record
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        text = json.dumps({'size': self._size, 'index': self._index})
+        with open(self._index_path, 'w') as fl:
+            fl.write(text)
+
+    def compact(self):
+        """
+        Rewrite data file without outdated records if there are too many of them
+        """
+        garbage = self._size - self._live
+        if garbage < COMPACTION_MIN_GARBAGE or garbage < self._live:
+            return
+        index, position = {}, 0
+        with open(self._data_path + '.tmp', 'wb') as fl:
+            for public_key, (offset, length, data_hash) in self._index.items():
+                fl.write(RECORD_HEADER.pack(str(public_key), str(data_hash), length) + self.get(public_key))
+                index[public_key] = [position + RECORD_HEADER.size, length, data_hash]
+                position += RECORD_HEADER.size + length
+        self.close_map()
+        self._file.close()
+        if os.path.isfile(self._index_path):  # offsets in saved index are wrong for new data file
+            os.remove(self._index_path)
+        self.replace(self._data_path + '.tmp', self._data_path)
+        self._file = open(self._data_path, 'r+b')
+        self._index, self._size, self._live = index, position, position
+        self._dirty = True
+        self.save_index()
+
+    @staticmethod
+    def replace(source, destination):
+        """
+        Replace file. Rename is atomic on POSIX systems. On Windows destination can't be replaced by rename,
+        it's kept as backup until new file is in place
+        """
+        if system() != 'Windows':
+            os.rename(source, destination)
+            return
+        backup = destination + '.bak'
+        if os.path.isfile(backup):
+            os.remove(backup)
+        os.rename(destination, backup)
+        os.rename(source, destination)
+        os.remove(backup)
+
+    def close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        self.close_map()
+        self._file.close()
+        self.save_index()
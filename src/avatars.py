@@ -0,0 +1,210 @@
+from PySide import QtCore, QtGui
+from toxcore_enums_and_consts import TOX_PUBLIC_KEY_SIZE
+from util import curr_directory, log, LRUCache, Singleton
+from tox import Tox
+from avatar_store import AvatarStore
+import settings
+import json
+import os
+import time
+
+
+AVATAR_SIZE = 64  # size of avatars in friends list, active friend's info and incoming call widget
+
+AVATARS_CACHE_SIZE = 512
+
+MAX_AVATAR_SIZE = 512 * 1024  # friends don't accept bigger avatars
+
+MIN_AVATAR_RESOLUTION = 32
+
+SENT_AVATAR_EXPIRATION = 7 * 24 * 60 * 60  # seconds, see SentAvatars.set_sent
+
+
+class AvatarCache(object):
+    """
+    Shared cache of decoded and scaled avatars. Key - tuple (public key, hash of avatar, size)
+    """
+    _pixmaps = LRUCache(AVATARS_CACHE_SIZE)
+
+    @staticmethod
+    def get_pixmap(tox_id, size=AVATAR_SIZE):
+        """
+        Get avatar of contact or default avatar
+        :param tox_id: public key or tox id
+        :param size: size of avatar in pixels
+        :return: QPixmap instance
+        """
+        public_key = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
+        store = AvatarStore.get_instance()
+        avatar_hash = store.get_hash(public_key)
+        key = (public_key, avatar_hash, size) if avatar_hash is not None else (None, None, size)
+        pixmap = AvatarCache._pixmaps.get(key)
+        if pixmap is None:
+            pixmap = QtGui.QPixmap(QtCore.QSize(size, size))
+            if avatar_hash is None:  # default avatar
+                pixmap.load(curr_directory() + '/images/avatar.png')
+            else:
+                pixmap.loadFromData(store.get(public_key), 'PNG')
+            pixmap = pixmap.scaled(size, size, QtCore.Qt.KeepAspectRatio)
+            AvatarCache._pixmaps[key] = pixmap
+        return pixmap
+
+    @staticmethod
+    def invalidate(tox_id):
+        """
+        Avatar of contact was changed or removed
+        :param tox_id: public key or tox id
+        """
+        public_key = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
+        for key in filter(lambda x: x[0] == public_key, AvatarCache._pixmaps.keys()):
+            AvatarCache._pixmaps.pop(key)
+
+
+def open_avatar_store():
+    """
+    Open packed avatars storage of current profile. Avatars saved as separate files are moved to storage
+    :return: AvatarStore instance
+    """
+    directory = settings.ProfileStorage.get_instance().get_avatars_directory()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    store = AvatarStore(directory)
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.png') and len(file_name) == TOX_PUBLIC_KEY_SIZE * 2 + 4:
+            path = directory + file_name
+            with open(path, 'rb') as fl:
+                data = fl.read()
+            if data:
+                store.set(str(file_name[:-4]), data, Tox.hash(data))
+            os.remove(path)
+    if os.path.isfile(directory + 'index.json'):  # index of avatar files
+        os.remove(directory + 'index.json')
+    return store
+
+
+class SentAvatars(Singleton):
+    """
+    Persisted hashes of avatars which friends already have. Key - friend's public key, value - list [hash of avatar
+    or empty string if friend knows that avatar was reset, unix time when record expires or 0]. Hashes are saved
+    on close
+    """
+
+    def __init__(self):
+        self._path = settings.ProfileStorage.get_instance().get_avatars_directory() + 'sent.json'
+        self._hashes = {}
+        self._dirty = False
+        if os.path.isfile(self._path):
+            try:
+                with open(self._path) as fl:
+                    self._hashes = json.loads(fl.read())
+            except Exception as ex:
+                log('Sent avatars data is broken: ' + str(ex))
+
+    def is_sent(self, tox_id, avatar_hash):
+        """
+        :param tox_id: friend's public key
+        :param avatar_hash: hash of current avatar or None if there is no avatar
+        :return: True if friend already has this avatar
+        """
+        record = self._hashes.get(tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
+        if not isinstance(record, list) or record[0] != (avatar_hash or ''):
+            return False
+        return not record[1] or record[1] > time.time()
+
+    def set_sent(self, tox_id, avatar_hash, confirmed=True):
+        """
+        Friend got avatar or rejected it because it has the same avatar
+        :param confirmed: False if friend only cancelled offer without requesting data. Such record expires
+        after SENT_AVATAR_EXPIRATION, because friend may reject avatars for other reasons
+        """
+        record = [avatar_hash or '', 0 if confirmed else int(time.time() + SENT_AVATAR_EXPIRATION)]
+        public_key = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
+        if self._hashes.get(public_key) != record:
+            self._hashes[public_key] = record
+            self._dirty = True
+
+    def remove(self, tox_id):
+        if self._hashes.pop(tox_id[:TOX_PUBLIC_KEY_SIZE * 2], None) is not None:
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        text = json.dumps(self._hashes)
+        with open(self._path, 'w') as fl:
+            fl.write(text)
+
+
+class AvatarOptimizer(QtCore.QThread):
+    """
+    Prepares new avatar of user in background: downsizes image to resolution from settings, re-encodes it
+    with max compression without metadata and validates result
+    """
+    _result = QtCore.Signal(object)
+
+    def __init__(self, path, callback):
+        """
+        :param path: path to image
+        :param callback: function which gets PNG data (string) or None if image is invalid. Called in main thread
+        """
+        QtCore.QThread.__init__(self)
+        self._path = path
+        self._callback = callback
+        self._cancelled = False
+        self._result.connect(self.done)
+
+    def cancel(self):
+        """
+        Stop optimization, callback won't be called. Called in main thread
+        """
+        self._cancelled = True
+
+    def run(self):
+        try:
+            self._result.emit(self.optimize())
+        except Exception as ex:
+            log('Avatar optimization failed: ' + str(ex))
+            self._result.emit(None)
+
+    def optimize(self):
+        """
+        :return: PNG data or None
+        """
+        image = QtGui.QImage(self._path)
+        if image.isNull():
+            return None
+        resolution = settings.Settings.get_instance()['avatar_resolution']
+        while resolution >= MIN_AVATAR_RESOLUTION and not self._cancelled:
+            data = AvatarOptimizer.encode(image, resolution)
+            if len(data) <= MAX_AVATAR_SIZE and not QtGui.QImage.fromData(data, 'PNG').isNull():
+                return data
+            resolution /= 2
+        return None
+
+    @staticmethod
+    def encode(image, resolution):
+        """
+        Scale image and encode it to PNG. Image is drawn on new blank image so no metadata is saved
+        :param image: QImage instance
+        :param resolution: max width and height of result
+        :return: PNG data (string)
+        """
+        if image.width() > resolution or image.height() > resolution:
+            image = image.scaled(resolution, resolution, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        image_format = QtGui.QImage.Format_ARGB32 if image.hasAlphaChannel() else QtGui.QImage.Format_RGB32
+        result = QtGui.QImage(image.size(), image_format)
+        result.fill(0)
+        painter = QtGui.QPainter(result)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        byte_array = QtCore.QByteArray()
+        buffer = QtCore.QBuffer(byte_array)
+        buffer.open(QtCore.QIODevice.WriteOnly)
+        result.save(buffer, 'PNG', 0)  # quality 0 - max compression
+        return str(byte_array.data())
+
+    @QtCore.Slot(object)
+    def done(self, data):
+        if not self._cancelled:
+            self._callback(data)
@@ -2,33 +2,112 @@ from PySide import QtCore
 from notifications import *
 from settings import Settings
 from profile import Profile
+from outgoing_queue import OutgoingQueue
+from typing_notifications import TypingNotifications
+from flood_control import FloodControl, FLOOD_STATE
 from toxcore_enums_and_consts import *
 from toxav_enums import *
 from tox import bin_to_string
 from ctypes import c_char_p, cast, pointer
+from collections import deque
+from itertools import count
+from util import log
 
 
-class InvokeEvent(QtCore.QEvent):
+class DrainEvent(QtCore.QEvent):
     EVENT_TYPE = QtCore.QEvent.Type(QtCore.QEvent.registerEventType())
 
-    def __init__(self, fn, *args, **kwargs):
-        QtCore.QEvent.__init__(self, InvokeEvent.EVENT_TYPE)
-        self.fn = fn
-        self.args = args
-        self.kwargs = kwargs
+    def __init__(self):
+        QtCore.QEvent.__init__(self, DrainEvent.EVENT_TYPE)
 
 
-class Invoker(QtCore.QObject):
+class EventBus(QtCore.QObject):
+    """
+    Calls from tox threads to main thread. Calls are appended to deque (its appends and pops are atomic, so no
+    locks are needed), main thread drains it once per event loop iteration and only one event is posted per batch.
+    Idempotent updates are merged by key: update is delivered once with arguments of last call, at position
+    of last call in queue
+    """
+
+    def __init__(self):
+        super(EventBus, self).__init__()
+        self._queue = deque()  # tuples (key, fn, args, kwargs), for updates fn is sequence number of call
+        self._updates = {}  # key - key of update, value - tuple (sequence number, fn, args, kwargs) of last update
+        self._sequence = count()  # next() of itertools.count is atomic
+        self._scheduled = False
+        self._stats = {'batches': 0, 'calls': 0, 'merged': 0, 'max_depth': 0}
+
+    def invoke(self, fn, args, kwargs):
+        self._queue.append((None, fn, args, kwargs))
+        self.schedule()
+
+    def update(self, key, fn, args, kwargs):
+        number = next(self._sequence)
+        self._updates[key] = (number, fn, args, kwargs)
+        self._queue.append((key, number, None, None))
+        self.schedule()
+
+    def schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            QtCore.QCoreApplication.postEvent(self, DrainEvent())
 
     def event(self, event):
-        event.fn(*event.args, **event.kwargs)
+        self._scheduled = False
+        depth = len(self._queue)
+        self._stats['batches'] += 1
+        self._stats['max_depth'] = max(self._stats['max_depth'], depth)
+        for _ in xrange(depth):  # calls added while batch is processed are delivered in next batch
+            key, fn, args, kwargs = self._queue.popleft()
+            if key is not None:
+                update = self._updates.get(key)
+                if update is None or update[0] != fn:  # it was merged with next update of this key
+                    self._stats['merged'] += 1
+                    continue
+                number, fn, args, kwargs = update  # last update is kept: tox thread can replace it concurrently
+            self._stats['calls'] += 1
+            try:
+                fn(*args, **kwargs)
+            except Exception as ex:
+                log('Call in main thread failed: ' + str(ex))
         return True
 
-_invoker = Invoker()
+    def clear(self):
+        """
+        Drop calls which were not delivered yet. Called in main thread when profile is closed
+        """
+        self._queue.clear()
+        self._updates.clear()
+
+    def get_stats(self):
+        """
+        :return: dict with count of batches, delivered and merged calls, max and current depth of queue
+        """
+        stats = dict(self._stats)
+        stats['depth'] = len(self._queue)
+        return stats
+
+_event_bus = EventBus()
 
 
 def invoke_in_main_thread(fn, *args, **kwargs):
-    QtCore.QCoreApplication.postEvent(_invoker, InvokeEvent(fn, *args, **kwargs))
+    _event_bus.invoke(fn, args, kwargs)
+
+
+def update_in_main_thread(key, fn, *args, **kwargs):
+    """
+    Idempotent call in main thread. If there are several updates with the same key in queue, only last is called
+    :param key: hashable key of update, for example tuple ('name', friend number)
+    """
+    _event_bus.update(key, fn, args, kwargs)
+
+
+def clear_main_thread_calls():
+    _event_bus.clear()
+
+
+def event_bus_stats():
+    return _event_bus.get_stats()
 
 # -----------------------------------------------------------------------------------------------------------------
 # Callbacks - current user
@@ -44,9 +123,9 @@ def self_connection_status(tox_link):
         profile = Profile.get_instance()
         if profile.status is None:
             status = tox_link.self_get_status()
-            invoke_in_main_thread(profile.set_status, status)
+            update_in_main_thread(('self_status', ), profile.set_status, status)
         elif connection == TOX_CONNECTION['NONE']:
-            invoke_in_main_thread(profile.set_status, None)
+            update_in_main_thread(('self_status', ), profile.set_status, None)
     return wrapped
 
 
@@ -64,8 +143,12 @@ def friend_status(tox, friend_num, new_status, user_data):
     friend = profile.get_friend_by_number(friend_num)
     if friend.status is None and Settings.get_instance()['sound_notifications'] and profile.status != TOX_USER_STATUS['BUSY']:
         sound_notification(SOUND_NOTIFICATION['FRIEND_CONNECTION_STATUS'])
-    invoke_in_main_thread(friend.set_status, new_status)
-    invoke_in_main_thread(profile.update_filtration)
+    update_in_main_thread(('status', friend_num), friend.set_status, new_status)
+    update_in_main_thread(('position', friend_num), profile.update_friend_position, friend)
+    update_in_main_thread(('filtration', ), profile.update_filtration)
+
+
+_connection_statuses = {}  # key - friend number, value - last connection status. Used only in tox thread
 
 
 def friend_connection_status(tox, friend_num, new_status, user_data):
@@ -75,13 +158,19 @@ def friend_connection_status(tox, friend_num, new_status, user_data):
     print "Friend #{} connected! Friend's status: {}".format(friend_num, new_status)
     profile = Profile.get_instance()
     friend = profile.get_friend_by_number(friend_num)
+    old_status = _connection_statuses.get(friend_num, TOX_CONNECTION['NONE'])
+    _connection_statuses[friend_num] = new_status
     if new_status == TOX_CONNECTION['NONE']:
-        invoke_in_main_thread(friend.set_status, None)
-        invoke_in_main_thread(profile.update_filtration)
+        update_in_main_thread(('status', friend_num), friend.set_status, None)
+        update_in_main_thread(('position', friend_num), profile.update_friend_position, friend)
+        update_in_main_thread(('filtration', ), profile.update_filtration)
+        OutgoingQueue.get_instance().remove(friend_num)  # unsent messages will be queued again on reconnect
+        TypingNotifications.get_instance().remove(friend_num)
         if Settings.get_instance()['sound_notifications'] and profile.status != TOX_USER_STATUS['BUSY']:
             sound_notification(SOUND_NOTIFICATION['FRIEND_CONNECTION_STATUS'])
-    elif friend.status is None:
+    elif old_status == TOX_CONNECTION['NONE']:  # friend went online, not changed udp to tcp or back
         invoke_in_main_thread(profile.send_avatar, friend_num)
+        invoke_in_main_thread(profile.send_pending_messages, friend_num)
 
 
 def friend_name(tox, friend_num, name, size, user_data):
@@ -91,9 +180,10 @@ def friend_name(tox, friend_num, name, size, user_data):
     profile = Profile.get_instance()
     friend = profile.get_friend_by_number(friend_num)
     print 'New name: ', str(friend_num), str(name)
-    invoke_in_main_thread(friend.set_name, name)
+    update_in_main_thread(('name', friend_num), friend.set_name, name)
+    update_in_main_thread(('index', friend_num), profile.index_friend, friend)
     if profile.get_active_number() == friend_num:
-        invoke_in_main_thread(profile.set_active)
+        update_in_main_thread(('active', ), profile.set_active)
 
 
 def friend_status_message(tox, friend_num, status_message, size, user_data):
@@ -103,10 +193,11 @@ def friend_status_message(tox, friend_num, status_message, size, user_data):
     """
     profile = Profile.get_instance()
     friend = profile.get_friend_by_number(friend_num)
-    invoke_in_main_thread(friend.set_status_message, status_message)
+    update_in_main_thread(('status_message', friend_num), friend.set_status_message, status_message)
+    update_in_main_thread(('index', friend_num), profile.index_friend, friend)
     print 'User #{} has new status: {}'.format(friend_num, status_message)
     if profile.get_active_number() == friend_num:
-        invoke_in_main_thread(profile.set_active)
+        update_in_main_thread(('active', ), profile.set_active)
 
 
 def friend_message(window, tray):
@@ -116,8 +207,12 @@ def friend_message(window, tray):
     def wrapped(tox, friend_number, message_type, message, size, user_data):
         profile = Profile.get_instance()
         settings = Settings.get_instance()
-        invoke_in_main_thread(profile.new_message, friend_number, message_type, message)
-        if not window.isActiveWindow():
+        flood_control = FloodControl.get_instance()
+        state = flood_control.check(friend_number, settings['flood_throttle_rate'], settings['flood_mute_rate'])
+        render = state != FLOOD_STATE['MUTED']  # muted messages are saved but not rendered
+        if flood_control.put_message(friend_number, message_type, message, render):  # first message of new batch
+            invoke_in_main_thread(show_messages)
+        if state == FLOOD_STATE['NORMAL'] and not window.isActiveWindow():
             friend = profile.get_friend_by_number(friend_number)
             if settings['notifications'] and profile.status != TOX_USER_STATUS['BUSY']:
                 invoke_in_main_thread(tray_notification, friend.name, message.decode('utf8'), tray, window)
@@ -126,6 +221,13 @@ def friend_message(window, tray):
     return wrapped
 
 
+def show_messages():
+    """
+    Render all buffered incoming messages as one batch. Called in main thread
+    """
+    Profile.get_instance().new_messages(FloodControl.get_instance().take_messages())
+
+
 def friend_request(tox, public_key, message, message_size, user_data):
     """
     Called when user get new friend request
@@ -138,6 +240,13 @@ def friend_request(tox, public_key, message, message_size, user_data):
         invoke_in_main_thread(profile.process_friend_request, tox_id, message.decode('utf-8'))
 
 
+def friend_read_receipt(tox, friend_number, message_id, user_data):
+    """
+    Friend received message
+    """
+    OutgoingQueue.get_instance().receipt(friend_number, message_id)
+
+
 def friend_typing(tox, friend_number, typing, user_data):
     invoke_in_main_thread(Profile.get_instance().friend_typing, friend_number, typing)
 
@@ -241,6 +350,40 @@ def callback_audio(toxav, friend_number, samples, audio_samples_per_channel, aud
 # Callbacks - initialization
 # -----------------------------------------------------------------------------------------------------------------
 
+_deferred = None  # callbacks of friends called while friends list is loaded - tuples (callback, args)
+
+
+def defer_friend_callbacks():
+    """
+    Network threads start before friends list is loaded. Callbacks of friends are queued until
+    release_friend_callbacks is called. Called in main thread before threads are started
+    """
+    global _deferred
+    _deferred = []
+
+
+def release_friend_callbacks():
+    """
+    Call queued callbacks in order they were received. Called in tox iterate thread between iterations when
+    all friends were loaded, so later callbacks are never called before queued ones
+    """
+    global _deferred
+    deferred, _deferred = _deferred or [], None
+    for callback, args in deferred:
+        callback(*args)
+
+
+def deferred_until_loaded(callback):
+    """
+    :param callback: callback of friend which arguments are copied values, not pointers to toxcore's buffers
+    """
+    def wrapped(*args):
+        if _deferred is not None:
+            _deferred.append((callback, args))
+        else:
+            callback(*args)
+    return wrapped
+
 
 def init_callbacks(tox, window, tray):
     """
@@ -249,23 +392,25 @@ def init_callbacks(tox, window, tray):
     :param window: main window
     :param tray: tray (for notifications)
     """
+    _connection_statuses.clear()  # new tox instance, all friends are offline
     tox.callback_self_connection_status(self_connection_status(tox), 0)
 
-    tox.callback_friend_status(friend_status, 0)
-    tox.callback_friend_message(friend_message(window, tray), 0)
-    tox.callback_friend_connection_status(friend_connection_status, 0)
-    tox.callback_friend_name(friend_name, 0)
-    tox.callback_friend_status_message(friend_status_message, 0)
+    tox.callback_friend_status(deferred_until_loaded(friend_status), 0)
+    tox.callback_friend_message(deferred_until_loaded(friend_message(window, tray)), 0)
+    tox.callback_friend_connection_status(deferred_until_loaded(friend_connection_status), 0)
+    tox.callback_friend_name(deferred_until_loaded(friend_name), 0)
+    tox.callback_friend_status_message(deferred_until_loaded(friend_status_message), 0)
     tox.callback_friend_request(friend_request, 0)
-    tox.callback_friend_typing(friend_typing, 0)
+    tox.callback_friend_typing(deferred_until_loaded(friend_typing), 0)
+    tox.callback_friend_read_receipt(friend_read_receipt, 0)
 
-    tox.callback_file_recv(tox_file_recv(window, tray), 0)
+    tox.callback_file_recv(deferred_until_loaded(tox_file_recv(window, tray)), 0)
     tox.callback_file_recv_chunk(file_recv_chunk, 0)
     tox.callback_file_chunk_request(file_chunk_request, 0)
-    tox.callback_file_recv_control(file_recv_control, 0)
+    tox.callback_file_recv_control(deferred_until_loaded(file_recv_control), 0)
 
     toxav = tox.AV
-    toxav.callback_call_state(call_state, 0)
-    toxav.callback_call(call, 0)
+    toxav.callback_call_state(deferred_until_loaded(call_state), 0)
+    toxav.callback_call(deferred_until_loaded(call), 0)
     toxav.callback_audio_receive_frame(callback_audio, 0)
 
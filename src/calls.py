@@ -2,6 +2,7 @@ import pyaudio
 import time
 import threading
 import settings
+from util import wake_scheduler
 from toxav_enums import *
 # TODO: play sound until outgoing call will be started or cancelled and add timeout
 
@@ -34,11 +35,15 @@ class AV(object):
     def __contains__(self, friend_number):
         return friend_number in self._calls
 
+    def has_calls(self):
+        return self._running and bool(self._calls)
+
     def __call__(self, friend_number, audio, video):
         """Call friend with specified number"""
         self._toxav.call(friend_number, 32 if audio else 0, 5000 if video else 0)
         self._calls[friend_number] = CALL_TYPE['AUDIO']
         self.start_audio_thread()
+        wake_scheduler()  # toxav is iterated only while there are calls
 
     def finish_call(self, friend_number, by_friend=False):
 
@@ -131,6 +136,7 @@ class AV(object):
             self._calls[friend_number] = int(video_enabled) * 2 + int(audio_enabled)
             self._toxav.answer(friend_number, 32 if audio_enabled else 0, 5000 if video_enabled else 0)
             self.start_audio_thread()
+            wake_scheduler()
 
     def toxav_call_state_cb(self, friend_number, state):
         """
@@ -0,0 +1,100 @@
+CHAT_VIEWS_CACHE_SIZE = 5  # count of conversations kept rendered in memory
+
+CHAT_VIEW_MAX_ROWS = 126  # max count of rendered messages in one view, rows far from viewport are released
+
+
+class ChatView(object):
+    """
+    Rendered conversation with friend: messages list widget and its scroll position.
+    Hidden views are kept in cache to switch between chats without rebuilding of message widgets.
+    View renders sliding window of friend's messages: rows far from viewport are released and
+    loaded again when user scrolls back to them
+    """
+
+    def __init__(self, messages):
+        """
+        :param messages: QListWidget instance
+        """
+        self._messages = messages
+        self._scroll = None
+        self._newer = 0  # count of newest messages which are not rendered
+        self._muted = 0  # count of newest messages muted by flood control while bottom of chat was rendered
+
+    def get_messages(self):
+        return self._messages
+
+    messages = property(get_messages)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Window of rendered messages
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get_newer(self):
+        return self._newer
+
+    def set_newer(self, value):
+        self._newer = value
+        self._muted = min(self._muted, value)
+
+    newer = property(get_newer, set_newer)
+
+    def skip_newest(self, muted):
+        """
+        New message is not rendered
+        :param muted: message was muted by flood control
+        """
+        if self._newer == self._muted and (muted or self._muted):  # bottom of chat is hidden by flood only
+            self._muted += 1
+        self._newer += 1
+
+    def is_bottom_muted(self):
+        """
+        :return: True if all newest messages which are not rendered were hidden by flood control, user didn't
+        scroll up from them
+        """
+        return bool(self._newer) and self._newer == self._muted
+
+    def get_offset(self):
+        """
+        :return: count of newest messages which are rendered or were released from the bottom of view
+        """
+        return self._newer + self._messages.count()
+
+    def release_newest(self):
+        """
+        Remove rows from the bottom of view if there are too many rendered messages
+        """
+        while self._messages.count() > CHAT_VIEW_MAX_ROWS:
+            self._messages.takeItem(self._messages.count() - 1)
+            self._newer += 1
+
+    def release_oldest(self):
+        """
+        Remove rows from the top of view if there are too many rendered messages
+        :return: total height of removed rows
+        """
+        height = 0
+        while self._messages.count() > CHAT_VIEW_MAX_ROWS:
+            height += self._messages.takeItem(0).sizeHint().height()
+        return height
+
+    def clear(self):
+        self._messages.clear()
+        self._newer = self._muted = 0
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Visibility
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def show(self):
+        self._messages.show()
+        if self._scroll is not None:
+            self._messages.verticalScrollBar().setValue(self._scroll)
+
+    def hide(self):
+        self._scroll = self._messages.verticalScrollBar().value()
+        self._messages.hide()
+
+    def close(self):
+        self._messages.hide()
+        self._messages.deleteLater()
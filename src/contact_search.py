@@ -0,0 +1,245 @@
+import unicodedata
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+
+GRAM_SIZE = 3
+
+MIN_SIMILARITY = 0.4  # min part of query's trigrams which contact must contain
+
+KEY_PREFIX_SIZE = 16  # length of public key prefix which can be searched
+
+
+def normalize(text):
+    """
+    Prepare text for search: lowercase, without accents and extra whitespace
+    :param text: unicode or utf-8 string
+    :return: normalized unicode string
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return u' '.join(text.lower().split())
+
+
+def grams(text):
+    """
+    :return: set of trigrams of text. Words are padded with spaces so short words have trigrams too
+    """
+    text = u' ' + text + u' '
+    return set(text[i:i + GRAM_SIZE] for i in xrange(len(text) - GRAM_SIZE + 1))
+
+
+def get_prefixes(texts):
+    """
+    :return: set of 1 and 2 first letters of words in texts
+    """
+    return set(word[:i] for text in texts for word in text.split() for i in (1, 2))
+
+
+class ContactSearchIndex(object):
+    """
+    Search index over contacts' names, aliases, status messages and public keys. Names and status messages are
+    indexed by trigrams and by word prefixes (for short queries), public keys - by prefix in sorted list.
+    Results are ranked: exact matches in names are better than matches in status messages, substring matches
+    are better than fuzzy matches with typos
+    """
+
+    def __init__(self):
+        self._names = {}  # key - contact's key, value - list of normalized names (name, alias)
+        self._padded_names = {}  # key - contact's key, value - list of normalized names padded with spaces
+        self._status_messages = {}  # key - contact's key, value - normalized status message
+        self._status_keys = defaultdict(set)  # key - normalized status message, value - set of contacts' keys
+        self._public_keys = {}  # key - contact's key, value - lowercase prefix of public key
+        self._grams = defaultdict(set)  # key - trigram, value - set of contacts' keys
+        self._name_grams = defaultdict(set)  # key - trigram, value - set of keys of contacts with it in name
+        self._name_prefixes = defaultdict(set)  # key - 1 or 2 first letters of word in name, value - set of keys
+        self._status_prefixes = defaultdict(set)  # the same for words in status messages
+        self._sorted_keys = []  # sorted list of tuples (public key prefix, contact's key)
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Indexing
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def add(self, key, names, status_message, public_key):
+        """
+        Add contact to index or update indexed data
+        :param key: contact's key, for example friend number
+        :param names: list of names of contact (name and alias)
+        :param status_message: status message of contact
+        :param public_key: public key of contact
+        """
+        if key in self._names:
+            self.remove(key)
+        self._names[key] = [normalize(name) for name in names if name]
+        self._padded_names[key] = [u' ' + name + u' ' for name in self._names[key]]
+        self._status_messages[key] = normalize(status_message or '')
+        self._status_keys[self._status_messages[key]].add(key)
+        self._public_keys[key] = public_key[:KEY_PREFIX_SIZE].lower()
+        for gram in self.get_contact_grams(key):
+            self._grams[gram].add(key)
+        for gram in self.get_name_grams(key):
+            self._name_grams[gram].add(key)
+        for prefix in get_prefixes(self._names[key]):
+            self._name_prefixes[prefix].add(key)
+        for prefix in get_prefixes([self._status_messages[key]]):
+            self._status_prefixes[prefix].add(key)
+        insort(self._sorted_keys, (self._public_keys[key], key))
+
+    def remove(self, key):
+        if key not in self._names:
+            return
+        for index, contact_grams in ((self._grams, self.get_contact_grams(key)),
+                                     (self._name_grams, self.get_name_grams(key))):
+            for gram in contact_grams:
+                index[gram].discard(key)
+                if not index[gram]:
+                    del index[gram]
+        for prefixes, texts in ((self._name_prefixes, self._names[key]),
+                                (self._status_prefixes, [self._status_messages[key]])):
+            for prefix in get_prefixes(texts):
+                prefixes[prefix].discard(key)
+                if not prefixes[prefix]:
+                    del prefixes[prefix]
+        self._status_keys[self._status_messages[key]].discard(key)
+        if not self._status_keys[self._status_messages[key]]:
+            del self._status_keys[self._status_messages[key]]
+        del self._sorted_keys[bisect_left(self._sorted_keys, (self._public_keys[key], key))]
+        del self._names[key], self._padded_names[key], self._status_messages[key], self._public_keys[key]
+
+    def get_contact_grams(self, key):
+        return grams(self._status_messages[key]) | self.get_name_grams(key)
+
+    def get_name_grams(self, key):
+        return set().union(*[grams(name) for name in self._names[key]])
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Search
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def search(self, query):
+        """
+        Find contacts matching query
+        :param query: search string
+        :return: list of contacts' keys, best matches first
+        """
+        query = normalize(query)
+        if not query:
+            return sorted(self._names.keys())
+        candidates = self.find_by_public_key(query)
+        if len(query) < GRAM_SIZE:  # too short for fuzzy search, only words starting with query are found
+            names = self._name_prefixes.get(query, set())
+            first = set(key for key in names if any(name.startswith(query) for name in self._names[key]))
+            groups = (first, names - first, candidates - names, self._status_prefixes.get(query, set()))
+            result, found = [], set()
+            for group in groups:
+                result.extend(sorted(group - found))
+                found |= group
+            return result
+        found = self.find_by_grams(query)
+        return self.ranked(found | candidates, query, candidates)
+
+    def ranked(self, keys, query, key_matches=frozenset()):
+        """
+        Contacts which names have no trigrams of query are ranked only by status message. Usually most of found
+        contacts are such (status message is a default one), their score is computed once per status message
+        :param key_matches: set of keys which public keys start with query
+        :return: list of keys sorted by score, keys with equal score are sorted by value
+        """
+        query_grams, status_scores = grams(query), {}
+        in_names = set().union(*[self._name_grams.get(gram, ()) for gram in query_grams]) | key_matches
+        others = keys - in_names
+        groups = defaultdict(list)  # key - score, value - list of keys with this score
+        for key in in_names & keys:
+            groups[self.rank(key, query, query_grams, status_scores)].append(key)
+        for status_message in set(map(self._status_messages.__getitem__, others)):
+            if status_message not in status_scores:
+                status_scores[status_message] = self.rank_status(status_message, query, query_grams)
+            score, fuzzy_score = status_scores[status_message]
+            groups[score or fuzzy_score].extend(self._status_keys[status_message] & others)
+        result = []
+        for score in sorted(groups, reverse=True):
+            result.extend(sorted(groups[score]))
+        return result
+
+    def find_by_public_key(self, query):
+        query = query.replace(u' ', u'')
+        if len(query) > KEY_PREFIX_SIZE:
+            return set()
+        result = set()
+        i = bisect_left(self._sorted_keys, (query, ))
+        while i < len(self._sorted_keys) and self._sorted_keys[i][0].startswith(query):
+            result.add(self._sorted_keys[i][1])
+            i += 1
+        return result
+
+    def find_by_grams(self, query):
+        """
+        Fuzzy search: contacts which contain at least MIN_SIMILARITY part of query's trigrams.
+        Contacts are counted by set operations instead of loop over keys: at_least[i] is the set of contacts
+        found in more than i of already processed posting lists
+        """
+        postings = [self._grams.get(gram, set()) for gram in grams(query)]
+        required = max(int(len(postings) * MIN_SIMILARITY + 0.5), 1)
+        at_least = [set() for _ in xrange(required)]
+        for posting in postings:
+            for i in xrange(required - 1, 0, -1):
+                at_least[i] |= at_least[i - 1] & posting
+            at_least[0] |= posting
+        return at_least[-1]
+
+    def rank(self, key, query, query_grams=None, status_scores=None):
+        """
+        :param query_grams: trigrams of query, computed once for all ranked contacts
+        :param status_scores: dict used as cache: key - status message, value - tuple (score, fuzzy score).
+        Many contacts have the same status message (for example, default one), it's ranked once
+        :return: score of contact for query, bigger is better
+        """
+        if query_grams is None:
+            query_grams = grams(query)
+        score = 0.
+        word = u' ' + query
+        for name in self._padded_names[key]:
+            if word not in name:
+                if query in name:
+                    score = max(score, 6.)
+            elif name == word + u' ':
+                score = max(score, 10.)
+            elif name.startswith(word):
+                score = max(score, 8.)
+            else:  # prefix of word
+                score = max(score, 7.)
+        if self._public_keys[key].startswith(query.replace(u' ', u'')):
+            score = max(score, 5.)
+        status_message = self._status_messages[key]
+        if status_scores is None or status_message not in status_scores:
+            status_score = self.rank_status(status_message, query, query_grams)
+            if status_scores is not None:
+                status_scores[status_message] = status_score
+        else:
+            status_score = status_scores[status_message]
+        score = max(score, status_score[0])
+        if not score:  # fuzzy match
+            for name in self._padded_names[key]:
+                score = max(score, 2. * sum(1 for gram in query_grams if gram in name) / len(query_grams))
+            score = max(score, status_score[1])
+        return score
+
+    @staticmethod
+    def rank_status(status_message, query, query_grams):
+        """
+        :return: tuple (score of status message, score of fuzzy match)
+        """
+        if (u' ' + status_message).find(u' ' + query) != -1:
+            return 4., 0.
+        elif query in status_message:
+            return 3., 0.
+        status_message = u' ' + status_message + u' '
+        return 0., 1. * sum(1 for gram in query_grams if gram in status_message) / len(query_grams)
@@ -1,10 +1,13 @@
 from toxcore_enums_and_consts import TOX_FILE_KIND, TOX_FILE_CONTROL
-from os.path import basename, getsize, exists
+from os.path import basename, getsize
 from os import remove
 from time import time, sleep
-from tox import Tox
-import settings
+from avatars import MAX_AVATAR_SIZE
+from avatar_store import AvatarStore
+from tox_commands import ToxCommands
+from util import log
 from PySide import QtCore
+import zlib
 
 
 TOX_FILE_TRANSFER_STATE = {
@@ -14,6 +17,12 @@ TOX_FILE_TRANSFER_STATE = {
     'FINISHED': 3,
 }
 
+TEXT_FILE_NAME = 'toxygen_text.txt.gz'  # long text messages are sent as gzip compressed files with this name
+
+MAX_TEXT_FILE_SIZE = 4 * 1024 * 1024  # max size of compressed text which is accepted automatically
+
+MAX_TEXT_SIZE = 64 * 1024 * 1024  # received texts are truncated to this size
+
 
 class StateSignal(QtCore.QObject):
     signal = QtCore.Signal(int, float)
@@ -61,19 +70,49 @@ class FileTransfer(QtCore.QObject):
         self._state_changed.signal.emit(TOX_FILE_CONTROL['CANCEL'], 1)
 
     def send_control(self, control):
-        if self._tox.file_control(self._friend_number, self._file_number, control):
-            self.state = control
-            self._state_changed.signal.emit(self.state, self._done / self._size if self._size else 0)
+        """
+        State is changed immediately and restored if toxcore rejects control
+        """
+        previous = self.state
+
+        def sent(future):
+            if future.exception() is not None:
+                log('File control failed: ' + str(future.exception()))
+                if self.state == control:
+                    self.state = previous
+                    self._state_changed.signal.emit(self.state, self._done / self._size if self._size else 0)
+        ToxCommands.get_instance().call(self._tox.file_control, self._friend_number, self._file_number,
+                                        control).add_done_callback(sent)
+        self.state = control
+        self._state_changed.signal.emit(self.state, self._done / self._size if self._size else 0)
 
     def get_file_id(self):
         return self._tox.file_get_file_id(self._friend_number, self._file_number)
 
+    def start(self, transfers):
+        """
+        Start outgoing transfer. File is sent in tox iterate thread and transfer is added to transfers there,
+        before toxcore requests its first chunk
+        :param transfers: dict of transfers, key - tuple (friend number, file number)
+        :return: ToxFuture instance, its result is file number. Its callbacks are called in main thread
+        """
+        kind, file_id, file_name = self._outgoing
+
+        def file_send():
+            self._file_number = self._tox.file_send(self._friend_number, kind, int(self._size), file_id, file_name)
+            transfers[(self._friend_number, self._file_number)] = self
+            return self._file_number
+        return ToxCommands.get_instance().call(file_send)
+
 # -----------------------------------------------------------------------------------------------------------------
 # Send file
 # -----------------------------------------------------------------------------------------------------------------
 
 
 class SendTransfer(FileTransfer):
+    """
+    Send file. Transfer is started by start()
+    """
 
     def __init__(self, path, tox, friend_number, kind=TOX_FILE_KIND['DATA'], file_id=None):
         if path is not None:
@@ -82,8 +121,7 @@ class SendTransfer(FileTransfer):
         else:
             size = 0
         super(SendTransfer, self).__init__(path, tox, friend_number, size)
-        self._file_number = tox.file_send(friend_number, kind, size, file_id,
-                                          basename(path).encode('utf-8') if path else '')
+        self._outgoing = (kind, file_id, basename(path).encode('utf-8') if path else '')
 
     def send_chunk(self, position, size):
         """
@@ -94,7 +132,8 @@ class SendTransfer(FileTransfer):
         if size:
             self._file.seek(position)
             data = self._file.read(size)
-            self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
+            ToxCommands.get_instance().call(self._tox.file_send_chunk, self._friend_number, self._file_number,
+                                            position, data)
             self._done += size
             self._state_changed.signal.emit(self.state, self._done / self._size)
         else:
@@ -103,29 +142,15 @@ class SendTransfer(FileTransfer):
             self._state_changed.signal.emit(self.state, 1)
 
 
-class SendAvatar(SendTransfer):
-    """
-    Send avatar to friend. Doesn't need file transfer item
-    """
-
-    def __init__(self, path, tox, friend_number):
-        if path is None:
-            hash = None
-        else:
-            with open(path, 'rb') as fl:
-                hash = Tox.hash(fl.read())
-        super(SendAvatar, self).__init__(path, tox, friend_number, TOX_FILE_KIND['AVATAR'], hash)
-
-
 class SendFromBuffer(FileTransfer):
     """
-    Send inline image
+    Send inline image. Transfer is started by start()
     """
 
-    def __init__(self, tox, friend_number, data, file_name):
+    def __init__(self, tox, friend_number, data, file_name, kind=TOX_FILE_KIND['DATA'], file_id=None):
         super(SendFromBuffer, self).__init__(None, tox, friend_number, len(data))
         self._data = data
-        self._file_number = tox.file_send(friend_number, TOX_FILE_KIND['DATA'], len(data), None, file_name)
+        self._outgoing = (kind, file_id, file_name)
 
     def get_data(self):
         return self._data
@@ -133,13 +158,67 @@ class SendFromBuffer(FileTransfer):
     def send_chunk(self, position, size):
         if size:
             data = self._data[position:position + size]
-            self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
+            ToxCommands.get_instance().call(self._tox.file_send_chunk, self._friend_number, self._file_number,
+                                            position, data)
             self._done += size
             self._state_changed.signal.emit(self.state, self._done / self._size)
         else:
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self._state_changed.signal.emit(self.state, 1)
 
+
+class SendText(SendFromBuffer):
+    """
+    Long text message sent as gzip compressed file
+    """
+
+    def __init__(self, tox, friend_number, text, pending_id):
+        """
+        :param text: text of message
+        :param pending_id: id of pending message in db
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 - gzip format
+        data = compressor.compress(text.encode('utf-8')) + compressor.flush()
+        super(SendText, self).__init__(tox, friend_number, data, TEXT_FILE_NAME)
+        self._text, self._pending_id = text, pending_id
+
+    def get_text(self):
+        return self._text
+
+    def get_pending_id(self):
+        return self._pending_id
+
+
+class SendAvatar(SendFromBuffer):
+    """
+    Send avatar to friend. Doesn't need file transfer item. Avatar data and its hash are computed once and shared by
+    transfers to all friends
+    """
+
+    def __init__(self, tox, friend_number, data, avatar_hash):
+        """
+        :param data: avatar data (string) or empty string if avatar was reset
+        :param avatar_hash: hash of avatar or None if avatar was reset
+        """
+        super(SendAvatar, self).__init__(tox, friend_number, data, 'avatar.png' if data else '',
+                                         TOX_FILE_KIND['AVATAR'], avatar_hash)
+        self._hash = avatar_hash
+        self._requested = False
+
+    def get_hash(self):
+        return self._hash
+
+    def is_requested(self):
+        """
+        :return: True if friend requested any chunk of avatar. Friend which has the same avatar cancels transfer
+        without requesting data
+        """
+        return self._requested
+
+    def send_chunk(self, position, size):
+        self._requested = True
+        super(SendAvatar, self).send_chunk(position, size)
+
 # -----------------------------------------------------------------------------------------------------------------
 # Receive file
 # -----------------------------------------------------------------------------------------------------------------
@@ -189,11 +268,10 @@ class ReceiveToBuffer(FileTransfer):
 
     def __init__(self, tox, friend_number, size, file_number):
         super(ReceiveToBuffer, self).__init__(None, tox, friend_number, size, file_number)
-        self._data = ''
-        self._data_size = 0
+        self._data = bytearray()  # chunks are written in place
 
     def get_data(self):
-        return self._data
+        return str(self._data)
 
     def write_chunk(self, position, data):
         if data is None:
@@ -202,40 +280,54 @@ class ReceiveToBuffer(FileTransfer):
         else:
             data = ''.join(chr(x) for x in data)
             l = len(data)
-            if self._data_size < position:
-                self._data += ('\0' * (position - self._data_size))
-            self._data = self._data[:position] + data + self._data[position + l:]
-            if position + l > self._data_size:
-                self._data_size = position + l
+            if len(self._data) < position:
+                self._data.extend('\0' * (position - len(self._data)))
+            self._data[position:position + l] = data
             self._done += l
             self._state_changed.signal.emit(self.state, self._done / self._size)
 
 
-class ReceiveAvatar(ReceiveTransfer):
+class ReceiveText(ReceiveToBuffer):
     """
-    Get friend's avatar. Doesn't need file transfer item
+    Long text message sent by friend as gzip compressed file
     """
-    MAX_AVATAR_SIZE = 512 * 1024
+
+    def get_text(self):
+        """
+        :return: utf-8 text truncated to MAX_TEXT_SIZE or None if data is invalid
+        """
+        try:
+            text = zlib.decompressobj(31).decompress(self.get_data(), MAX_TEXT_SIZE)
+        except zlib.error:
+            return None
+        return text.decode('utf-8', 'ignore').encode('utf-8')
+
+
+class ReceiveAvatar(ReceiveToBuffer):
+    """
+    Get friend's avatar. Doesn't need file transfer item. Avatar is saved to avatars storage when transfer is finished
+    """
+    MAX_AVATAR_SIZE = MAX_AVATAR_SIZE
 
     def __init__(self, tox, friend_number, size, file_number):
-        path = settings.ProfileHelper.get_path() + '/avatars/{}.png'.format(tox.friend_get_public_key(friend_number))
-        super(ReceiveAvatar, self).__init__(path, tox, friend_number, size, file_number)
+        super(ReceiveAvatar, self).__init__(tox, friend_number, size, file_number)
+        self._public_key = tox.friend_get_public_key(friend_number)
+        store = AvatarStore.get_instance()
         if size > self.MAX_AVATAR_SIZE:
             self.send_control(TOX_FILE_CONTROL['CANCEL'])
-        elif exists(path):
-            if not size:
+        elif not size:  # friend removed avatar
+            self.send_control(TOX_FILE_CONTROL['CANCEL'])
+            self.state = TOX_FILE_TRANSFER_STATE['CANCELED']
+            store.remove(self._public_key)
+        else:
+            self._hash = self.get_file_id()
+            if self._hash == store.get_hash(self._public_key):  # avatar wasn't changed
                 self.send_control(TOX_FILE_CONTROL['CANCEL'])
                 self.state = TOX_FILE_TRANSFER_STATE['CANCELED']
-                self._file.close()
-                remove(path)
             else:
-                hash = self.get_file_id()
-                with open(path, 'rb') as fl:
-                    existing_hash = Tox.hash(fl.read())
-                if hash == existing_hash:
-                    self.send_control(TOX_FILE_CONTROL['CANCEL'])
-                    self.state = TOX_FILE_TRANSFER_STATE['CANCELED']
-                else:
-                    self.send_control(TOX_FILE_CONTROL['RESUME'])
-        else:
-            self.send_control(TOX_FILE_CONTROL['RESUME'])
+                self.send_control(TOX_FILE_CONTROL['RESUME'])
+
+    def write_chunk(self, position, data):
+        super(ReceiveAvatar, self).write_chunk(position, data)
+        if self.state == TOX_FILE_TRANSFER_STATE['FINISHED']:
+            AvatarStore.get_instance().set(self._public_key, self.get_data(), self._hash)
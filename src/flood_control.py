@@ -0,0 +1,72 @@
+from collections import deque
+from util import log, Singleton
+import threading
+import time
+
+
+FLOOD_STATE = {
+    'NORMAL': 0,
+    'THROTTLED': 1,  # messages are shown without notifications
+    'MUTED': 2  # messages are saved to history without notifications and rendering
+}
+
+RATE_WINDOW = 1.  # rate of messages is count of messages in last RATE_WINDOW seconds
+
+
+class FloodControl(Singleton):
+    """
+    Per friend rate accounting of incoming messages and coalescing of them. Messages are received in tox iterate
+    thread and buffered, main thread takes all buffered messages at once and renders them as one batch
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._times = {}  # key - friend number, value - deque of unix times of recent messages
+        self._muted = {}  # key - friend number, value - count of muted messages
+        self._messages = []  # buffered messages - tuples (friend number, message type, message, render)
+
+    def check(self, friend_number, throttle_rate, mute_rate):
+        """
+        Account new message from friend. Called in tox iterate thread
+        :param friend_number: number of friend
+        :param throttle_rate: max count of messages per RATE_WINDOW with notifications, 0 - unlimited
+        :param mute_rate: max count of messages per RATE_WINDOW which are rendered, 0 - unlimited
+        :return: one of FLOOD_STATE values
+        """
+        now = time.time()
+        times = self._times.setdefault(friend_number, deque())
+        times.append(now)
+        while times[0] < now - RATE_WINDOW:
+            times.popleft()
+        rate = len(times)
+        if mute_rate and rate > mute_rate:
+            self._muted[friend_number] = self._muted.get(friend_number, 0) + 1
+            return FLOOD_STATE['MUTED']
+        if friend_number in self._muted:
+            log('Flood: {} messages from friend #{} were muted'.format(self._muted.pop(friend_number),
+                                                                       friend_number))
+        if throttle_rate and rate > throttle_rate:
+            return FLOOD_STATE['THROTTLED']
+        return FLOOD_STATE['NORMAL']
+
+    def remove(self, friend_number):
+        self._times.pop(friend_number, None)
+        self._muted.pop(friend_number, None)
+
+    def put_message(self, friend_number, message_type, message, render=True):
+        """
+        Buffer message until main thread takes it. Called in tox iterate thread
+        :param render: False if message is muted and should be only saved to history
+        :return: True if buffer was empty and main thread should be notified
+        """
+        with self._lock:
+            self._messages.append((friend_number, message_type, message, render))
+            return len(self._messages) == 1
+
+    def take_messages(self):
+        """
+        :return: list of all buffered messages. Called in main thread
+        """
+        with self._lock:
+            messages, self._messages = self._messages, []
+        return messages
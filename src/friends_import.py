@@ -0,0 +1,139 @@
+from PySide import QtCore
+from multiprocessing.pool import ThreadPool
+from toxcore_enums_and_consts import TOX_ADDRESS_SIZE
+from tox_dns import tox_dns
+from util import log
+import string
+
+
+DNS_THREADS = 4  # count of concurrent toxme lookups
+
+IMPORT_INTERVAL = 500  # ms between batches of friend requests
+
+IMPORT_BATCH_SIZE = 8  # count of friend requests sent in one batch
+
+
+def parse_ids(text):
+    """
+    Parse content of import file: one tox id or toxme address per line, empty lines and lines starting
+    with # are ignored
+    :param text: content of file
+    :return: list of tuples (line, error). Error is None for valid lines
+    """
+    result = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '@' in line:
+            result.append((line, None))
+        elif len(line) == TOX_ADDRESS_SIZE * 2 and all(c in string.hexdigits for c in line):
+            result.append((line.upper(), None))
+        else:
+            result.append((line, 'Invalid TOX ID'))
+    return result
+
+
+def resolve(data):
+    """
+    Get tox id of toxme address. Called in thread pool
+    :param data: tuple (line, error)
+    :return: tuple (line, tox id or None, error)
+    """
+    line, error = data
+    if error is not None:
+        return line, None, error
+    if '@' not in line:
+        return line, line, None
+    try:
+        tox_id = tox_dns(line)
+    except Exception as ex:
+        log('Import lookup failed: ' + str(ex))
+        tox_id = None
+    return (line, tox_id, None) if tox_id else (line, None, 'TOX DNS lookup failed')
+
+
+class FriendsImport(QtCore.QThread):
+    """
+    Bulk import of friends from file. Addresses are resolved concurrently in background, friend requests
+    are sent from main thread in batches at fixed rate
+    """
+    _resolved = QtCore.Signal(object)
+
+    def __init__(self, path, message, send_requests, callback):
+        """
+        :param path: path to file with tox ids and toxme addresses
+        :param message: message of friend requests
+        :param send_requests: function which gets list of tox ids, message and callback, sends requests and calls
+        callback with list of errors (None for successful requests). Called in main thread
+        :param callback: function which gets report - list of tuples (line, error). Called in main thread
+        """
+        QtCore.QThread.__init__(self)
+        self._path, self._message = path, message
+        self._send_requests, self._callback = send_requests, callback
+        self._pending = []  # resolved tox ids which will be added in next batches
+        self._report = []
+        self._resolving = True
+        self._sending = 0  # count of batches which are being sent
+        self._cancelled = False
+        self._resolved.connect(self.add)
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self.send_batch)
+
+    def start(self):
+        QtCore.QThread.start(self)
+        self._timer.start(IMPORT_INTERVAL)
+
+    def cancel(self):
+        """
+        Stop import, requests which were not sent yet are dropped and callback won't be called. Called in main thread
+        """
+        self._cancelled = True
+        self._timer.stop()
+
+    def run(self):
+        try:
+            with open(self._path) as fl:
+                data = parse_ids(fl.read())
+        except Exception as ex:
+            log('Import failed: ' + str(ex))
+            self._resolved.emit((self._path, None, str(ex)))
+            self._resolved.emit(None)
+            return
+        pool = ThreadPool(DNS_THREADS)
+        try:
+            for result in pool.imap(resolve, data):
+                if self._cancelled:
+                    pool.terminate()
+                    break
+                self._resolved.emit(result)
+        finally:
+            pool.close()
+            self._resolved.emit(None)  # all addresses were resolved
+
+    @QtCore.Slot(object)
+    def add(self, result):
+        if result is None:
+            self._resolving = False
+            return
+        line, tox_id, error = result
+        if tox_id is None:
+            self._report.append((line, error))
+        else:
+            self._pending.append((line, tox_id))
+
+    def send_batch(self):
+        if self._cancelled:
+            return
+        batch, self._pending = self._pending[:IMPORT_BATCH_SIZE], self._pending[IMPORT_BATCH_SIZE:]
+        if batch:
+            self._sending += 1
+            self._send_requests([tox_id for line, tox_id in batch], self._message,
+                                lambda errors: self.sent(batch, errors))
+        elif not self._resolving and not self._sending:  # all addresses were resolved and all requests were sent
+            self._timer.stop()
+            self._callback(self._report)
+
+    def sent(self, batch, errors):
+        self._sending -= 1
+        self._report.extend((line, error) for (line, tox_id), error in zip(batch, errors))
@@ -1,7 +1,6 @@
 # coding=utf-8
 from sqlite3 import connect
 import settings
-from os import chdir
 
 
 PAGE_SIZE = 42
@@ -16,26 +15,31 @@ class History(object):
 
     def __init__(self, name):
         self._name = name
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(name + '.hstr')
+        self._path = settings.ProfileStorage.get_instance().get_history_path(name)
+        db = connect(self._path)
         cursor = db.cursor()
         cursor.execute('CREATE TABLE IF NOT EXISTS friends('
                        '    tox_id TEXT PRIMARY KEY'
                        ')')
+        cursor.execute('CREATE TABLE IF NOT EXISTS pending('
+                       '    id INTEGER PRIMARY KEY,'
+                       '    tox_id TEXT,'
+                       '    message TEXT,'
+                       '    message_type INTEGER,'
+                       '    unix_time REAL'
+                       ')')
         db.close()
 
     def export(self, directory):
-        path = settings.ProfileHelper.get_path() + self._name + '.hstr'
         new_path = directory + self._name + '.hstr'
-        with open(path, 'rb') as fin:
+        with open(self._path, 'rb') as fin:
             data = fin.read()
         with open(new_path, 'wb') as fout:
             fout.write(data)
         print 'History exported to: {}'.format(new_path)
 
     def add_friend_to_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
+        db = connect(self._path)
         try:
             cursor = db.cursor()
             cursor.execute('INSERT INTO friends VALUES (?);', (tox_id, ))
@@ -53,9 +57,31 @@ class History(object):
         finally:
             db.close()
 
+    def add_friends_to_db(self, tox_ids):
+        """
+        Add many friends in one transaction. Existing friends are ignored
+        """
+        db = connect(self._path)
+        try:
+            cursor = db.cursor()
+            for tox_id in tox_ids:
+                cursor.execute('INSERT OR IGNORE INTO friends VALUES (?);', (tox_id, ))
+                cursor.execute('CREATE TABLE IF NOT EXISTS id' + tox_id + '('
+                               '    id INTEGER PRIMARY KEY,'
+                               '    message TEXT,'
+                               '    owner INTEGER,'
+                               '    unix_time REAL,'
+                               '    message_type INTEGER'
+                               ')')
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
     def delete_friend_from_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
+        db = connect(self._path)
         try:
             cursor = db.cursor()
             cursor.execute('DELETE FROM friends WHERE tox_id=?;', (tox_id, ))
@@ -68,8 +94,7 @@ class History(object):
             db.close()
 
     def friend_exists_in_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
+        db = connect(self._path)
         cursor = db.cursor()
         cursor.execute('SELECT 0 FROM friends WHERE tox_id=?', (tox_id, ))
         result = cursor.fetchone()
@@ -77,8 +102,7 @@ class History(object):
         return result is not None
 
     def save_messages_to_db(self, tox_id, messages_iter):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
+        db = connect(self._path)
         try:
             cursor = db.cursor()
             cursor.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) '
@@ -91,8 +115,7 @@ class History(object):
             db.close()
 
     def delete_messages(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
+        db = connect(self._path)
         try:
             cursor = db.cursor()
             cursor.execute('DELETE FROM id' + tox_id + ';')
@@ -103,13 +126,69 @@ class History(object):
         finally:
             db.close()
 
+    def add_pending(self, tox_id, message, message_type, unix_time):
+        """
+        Save message which wasn't sent yet
+        :return: id of pending message
+        """
+        db = connect(self._path)
+        try:
+            cursor = db.cursor()
+            cursor.execute('INSERT INTO pending(tox_id, message, message_type, unix_time) VALUES (?, ?, ?, ?);',
+                           (tox_id, message, message_type, unix_time))
+            db.commit()
+            return cursor.lastrowid
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def delete_pending(self, pending_id):
+        """
+        Message was sent. Can be called from any thread
+        """
+        db = connect(self._path)
+        try:
+            cursor = db.cursor()
+            cursor.execute('DELETE FROM pending WHERE id=?;', (pending_id, ))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def delete_pending_messages(self, tox_id):
+        db = connect(self._path)
+        try:
+            cursor = db.cursor()
+            cursor.execute('DELETE FROM pending WHERE tox_id=?;', (tox_id, ))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def get_pending(self, tox_id):
+        """
+        :return: list of tuples (id, message, message_type, unix_time) of unsent messages in order they were written
+        """
+        db = connect(self._path)
+        cursor = db.cursor()
+        cursor.execute('SELECT id, message, message_type, unix_time FROM pending WHERE tox_id=? ORDER BY id;',
+                       (tox_id, ))
+        result = cursor.fetchall()
+        db.close()
+        return result
+
     def messages_getter(self, tox_id):
-        return History.MessageGetter(self._name, tox_id)
+        return History.MessageGetter(self._path, tox_id)
 
     class MessageGetter(object):
-        def __init__(self, name, tox_id):
-            chdir(settings.ProfileHelper.get_path())
-            self._db = connect(name + '.hstr')
+        def __init__(self, path, tox_id):
+            self._db = connect(path)
             self._cursor = self._db.cursor()
             self._cursor.execute('SELECT message, owner, unix_time, message_type FROM id' + tox_id +
                                  ' ORDER BY unix_time DESC;')
@@ -3,10 +3,15 @@ from PySide import QtGui, QtCore
 import profile
 from file_transfers import TOX_FILE_TRANSFER_STATE
 from util import curr_directory, convert_time
-from messages import FILE_TRANSFER_MESSAGE_STATUS
+from messages import FILE_TRANSFER_MESSAGE_STATUS, MESSAGE_STATUS
 from widgets import DataLabel
 
 
+COLLAPSED_LINES = 10  # long messages are shown collapsed: only first lines are visible until user expands them
+
+COLLAPSED_LENGTH = 1024
+
+
 class MessageEdit(QtGui.QTextEdit):
 
     def __init__(self, text, width, parent=None):
@@ -27,8 +32,10 @@ class MessageEdit(QtGui.QTextEdit):
 
 class MessageItem(QtGui.QWidget):
     """
-    Message in messages list
+    Message in messages list. Long messages are collapsible
     """
+    resized = QtCore.Signal()
+
     def __init__(self, text, time, user='', message_type=TOX_MESSAGE_TYPE['NORMAL'], parent=None):
         QtGui.QWidget.__init__(self, parent)
         self.name = DataLabel(self)
@@ -51,10 +58,21 @@ class MessageItem(QtGui.QWidget):
         self.time.setFont(font)
         self.time.setObjectName("time")
         self.time.setText(time)
+        self._time = time
 
-        self.message = MessageEdit(text, parent.width() - 150, self)
+        self._text = text
+        self._preview = MessageItem.get_preview(text)
+        self._expanded = False
+        self.message = MessageEdit(self._preview or text, parent.width() - 150, self)
         self.message.setGeometry(QtCore.QRect(100, 0, parent.width() - 150, self.message.height()))
         self.setFixedHeight(self.message.height())
+        if self._preview is not None:
+            self.expand = QtGui.QPushButton(self)
+            self.expand.setGeometry(QtCore.QRect(0, 25, 95, 20))
+            self.expand.setText(QtGui.QApplication.translate("MainWindow", "Show more", None,
+                                                             QtGui.QApplication.UnicodeUTF8))
+            self.expand.clicked.connect(self.toggle)
+            self.setFixedHeight(max(self.message.height(), 50))
 
         if message_type == TOX_MESSAGE_TYPE['ACTION']:
             self.name.setStyleSheet("QLabel { color: #4169E1; }")
@@ -65,6 +83,36 @@ class MessageItem(QtGui.QWidget):
             if text[-1] == '<':
                 self.message.setStyleSheet("QTextEdit { color: red; }")
 
+    @staticmethod
+    def get_preview(text):
+        """
+        :return: first lines of long text or None if text is short
+        """
+        lines = text.split('\n', COLLAPSED_LINES)
+        if len(lines) <= COLLAPSED_LINES and len(text) <= COLLAPSED_LENGTH:
+            return None
+        return '\n'.join(lines[:COLLAPSED_LINES])[:COLLAPSED_LENGTH] + '...'
+
+    def toggle(self):
+        """
+        Expand or collapse long message
+        """
+        self._expanded = not self._expanded
+        self.message.setPlainText(self._text if self._expanded else self._preview)
+        self.message.setFixedHeight(self.message.document().size().height())
+        self.expand.setText(QtGui.QApplication.translate("MainWindow", "Show less" if self._expanded else "Show more",
+                                                         None, QtGui.QApplication.UnicodeUTF8))
+        self.setFixedHeight(max(self.message.height(), 50))
+        self.resized.emit()
+
+    @QtCore.Slot(int)
+    def set_status(self, status):
+        """
+        Show '...' if message is pending, gray time if friend didn't receive message yet and time otherwise
+        """
+        self.time.setText('...' if status == MESSAGE_STATUS['PENDING'] else self._time)
+        self.time.setStyleSheet("QLabel { color: gray; }" if status == MESSAGE_STATUS['SENT'] else '')
+
 
 class ContactItem(QtGui.QWidget):
     """
@@ -95,6 +143,18 @@ class ContactItem(QtGui.QWidget):
         self.connection_status.setObjectName("connection_status")
 
 
+class ContactListItem(QtGui.QListWidgetItem):
+    """
+    Row of friends list. When sorting is enabled rows with bigger sort key are higher
+    """
+    SORT_KEY_ROLE = QtCore.Qt.UserRole
+    NUMBER_ROLE = QtCore.Qt.UserRole + 1  # number of friend
+    NEW_ROW_SORT_KEY = -1.  # less than keys of friends, new rows are added to the end of sorted list
+
+    def __lt__(self, other):
+        return self.data(ContactListItem.SORT_KEY_ROLE) > other.data(ContactListItem.SORT_KEY_ROLE)
+
+
 class StatusCircle(QtGui.QWidget):
     """
     Connection status
@@ -5,8 +5,10 @@ from PySide import QtCore, QtGui
 from bootstrap import node_generator
 from mainscreen import MainWindow
 from profile import tox_factory
-from callbacks import init_callbacks
-from util import curr_directory, get_style
+from callbacks import init_callbacks, defer_friend_callbacks, release_friend_callbacks, event_bus_stats
+from scheduler import ToxScheduler
+from tox_commands import ToxCommands
+from util import curr_directory, get_style, wake_scheduler
 import styles.style
 import locale
 
@@ -15,7 +17,7 @@ class Toxygen(object):
 
     def __init__(self):
         super(Toxygen, self).__init__()
-        self.tox = self.ms = self.init = self.mainloop = self.avloop = None
+        self.tox = self.ms = self.init = self.mainloop = None
 
     def main(self):
         """
@@ -91,7 +93,7 @@ class Toxygen(object):
         app.installTranslator(translator)
         app.translator = translator
 
-        self.ms = MainWindow(self.tox, self.reset)
+        self.ms = MainWindow(self.tox, self.reset, self.switch_profile)
 
         # tray icon
         self.tray = QtGui.QSystemTrayIcon(QtGui.QIcon(curr_directory() + '/images/icon.png'))
@@ -119,23 +121,10 @@ class Toxygen(object):
         self.ms.show()
         QtGui.QApplication.setStyle(get_style(settings['theme']))  # set application style
 
-        # init thread
-        self.init = self.InitThread(self.tox, self.ms, self.tray)
-        self.init.start()
-
-        # starting threads for tox iterate and toxav iterate
-        self.mainloop = self.ToxIterateThread(self.tox)
-        self.mainloop.start()
-        self.avloop = self.ToxAVIterateThread(self.tox.AV)
-        self.avloop.start()
+        self.start_threads()
         app.connect(app, QtCore.SIGNAL("lastWindowClosed()"), app, QtCore.SLOT("quit()"))
         app.exec_()
-        self.init.stop = True
-        self.mainloop.stop = True
-        self.avloop.stop = True
-        self.mainloop.wait()
-        self.init.wait()
-        self.avloop.wait()
+        self.stop_threads()
         data = self.tox.get_savedata()
         ProfileHelper.save_profile(data)
         settings.close()
@@ -146,28 +135,74 @@ class Toxygen(object):
         Create new tox instance (new network settings)
         :return: tox instance
         """
-        self.mainloop.stop = True
-        self.init.stop = True
-        self.avloop.stop = True
-        self.mainloop.wait()
-        self.init.wait()
-        self.avloop.wait()
+        self.stop_threads()
         data = self.tox.get_savedata()
         ProfileHelper.save_profile(data)
         del self.tox
         # create new tox instance
         self.tox = tox_factory(data, Settings.get_instance())
+        self.start_threads()
+        return self.tox
+
+    def switch_profile(self, path, name, create):
+        """
+        Save current profile and load other profile without restart. Qt application, main window,
+        caches of images and audio devices are reused
+        :param path: directory of profile
+        :param name: name of profile
+        :param create: create new profile with this name
+        """
+        self.stop_threads()
+        self.ms.close_profile()
+        ProfileHelper.save_profile(self.tox.get_savedata())
+        settings = Settings.get_instance()
+        settings.close()
+        del self.tox  # kills tox and toxav
+        if create:
+            self.tox = tox_factory()
+            self.tox.self_set_name(name)
+            self.tox.self_set_status_message('Toxing on Toxygen')
+            ProfileHelper.save_profile(self.tox.get_savedata(), name)
+            settings = Settings(name)
+        else:
+            data = ProfileHelper.open_profile(path, name)
+            settings = Settings(name)
+            self.tox = tox_factory(data, settings)
+        settings.set_active_profile()
+
+        app = QtGui.QApplication.instance()
+        lang = filter(lambda x: x[0] == settings['language'], Settings.supported_languages())[0]
+        app.removeTranslator(app.translator)
+        app.translator.load(curr_directory() + '/translations/' + lang[1])
+        app.installTranslator(app.translator)
+        QtGui.QApplication.setStyle(get_style(settings['theme']))
+
+        self.ms.open_profile(self.tox)
+        self.start_threads()
+
+    def start_threads(self):
+        # friends list is loaded progressively, callbacks of friends are called when all friends are loaded
+        defer_friend_callbacks()
+        self.ms.profile.on_loaded(lambda: ToxCommands.get_instance().call(release_friend_callbacks))
+
         # init thread
         self.init = self.InitThread(self.tox, self.ms, self.tray)
         self.init.start()
 
-        # starting threads for tox iterate and toxav iterate
-        self.mainloop = self.ToxIterateThread(self.tox)
+        # starting thread for tox iterate and toxav iterate
+        self.mainloop = ToxScheduler(self.tox, self.ms.profile.call)
         self.mainloop.start()
 
-        self.avloop = self.ToxAVIterateThread(self.tox.AV)
-        self.avloop.start()
-        return self.tox
+    def stop_threads(self):
+        if self.init is not None:  # else threads were not started
+            self.init.stop = True
+            self.mainloop.stop = True
+            wake_scheduler()
+            self.mainloop.wait()
+            self.init.wait()
+            print 'Tox iterate stats:', self.mainloop.get_stats()
+            print 'Main thread calls stats:', event_bus_stats()
+        ToxCommands.get_instance().execute()  # queued calls change savedata, for example delete friends
 
     # -----------------------------------------------------------------------------------------------------------------
     # Inner classes
@@ -206,30 +241,6 @@ class Toxygen(object):
                 finally:
                     self.msleep(5000)
 
-    class ToxIterateThread(QtCore.QThread):
-
-        def __init__(self, tox):
-            QtCore.QThread.__init__(self)
-            self.tox = tox
-            self.stop = False
-
-        def run(self):
-            while not self.stop:
-                self.tox.iterate()
-                self.msleep(self.tox.iteration_interval())
-
-    class ToxAVIterateThread(QtCore.QThread):
-
-        def __init__(self, toxav):
-            QtCore.QThread.__init__(self)
-            self.toxav = toxav
-            self.stop = False
-
-        def run(self):
-            while not self.stop:
-                self.toxav.iterate()
-                self.msleep(self.toxav.iteration_interval())
-
     class Login(object):
 
         def __init__(self, arr):
@@ -3,6 +3,9 @@
 from menu import *
 from profile import *
 from list_items import *
+from loginscreen import LoginScreen
+from callbacks import clear_main_thread_calls
+import locale
 
 
 class MessageArea(QtGui.QPlainTextEdit):
@@ -10,8 +13,6 @@ class MessageArea(QtGui.QPlainTextEdit):
     def __init__(self, parent, form):
         super(MessageArea, self).__init__(parent)
         self.parent = form
-        self.timer = QtCore.QTimer(self)
-        self.timer.timeout.connect(lambda: self.parent.profile.send_typing(False))
 
     def keyPressEvent(self, event):
         if event.key() == QtCore.Qt.Key_Return:
@@ -24,17 +25,15 @@ class MessageArea(QtGui.QPlainTextEdit):
             self.appendPlainText(Profile.get_instance().get_last_message())
         else:
             self.parent.profile.send_typing(True)
-            if self.timer.isActive():
-                self.timer.stop()
-            self.timer.start(5000)
             super(MessageArea, self).keyPressEvent(event)
 
 
 class MainWindow(QtGui.QMainWindow):
 
-    def __init__(self, tox, reset):
+    def __init__(self, tox, reset, switch_profile):
         super(MainWindow, self).__init__()
         self.reset = reset
+        self.profile_switcher = switch_profile
         self.initUI(tox)
 
     def setup_menu(self, MainWindow):
@@ -67,8 +66,11 @@ class MainWindow(QtGui.QMainWindow):
         self.actionSettings = QtGui.QAction(MainWindow)
         self.actionSettings.setObjectName("actionSettings")
         self.audioSettings = QtGui.QAction(MainWindow)
+        self.actionSwitch_profile = QtGui.QAction(MainWindow)
+        self.actionSwitch_profile.setObjectName("actionSwitch_profile")
         self.menuProfile.addAction(self.actionAdd_friend)
         self.menuProfile.addAction(self.actionSettings)
+        self.menuProfile.addAction(self.actionSwitch_profile)
         self.menuSettings.addAction(self.actionPrivacy_settings)
         self.menuSettings.addAction(self.actionInterface_settings)
         self.menuSettings.addAction(self.actionNotifications)
@@ -87,6 +89,7 @@ class MainWindow(QtGui.QMainWindow):
         self.actionInterface_settings.triggered.connect(self.interface_settings)
         self.actionNotifications.triggered.connect(self.notification_settings)
         self.audioSettings.triggered.connect(self.audio_settings)
+        self.actionSwitch_profile.triggered.connect(self.switch_profile)
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
 
     def languageChange(self, *args, **kwargs):
@@ -106,6 +109,7 @@ class MainWindow(QtGui.QMainWindow):
         self.actionAbout_program.setText(QtGui.QApplication.translate("MainWindow", "About program", None, QtGui.QApplication.UnicodeUTF8))
         self.actionSettings.setText(QtGui.QApplication.translate("MainWindow", "Settings", None, QtGui.QApplication.UnicodeUTF8))
         self.audioSettings.setText(QtGui.QApplication.translate("MainWindow", "Audio", None, QtGui.QApplication.UnicodeUTF8))
+        self.actionSwitch_profile.setText(QtGui.QApplication.translate("MainWindow", "Switch profile", None, QtGui.QApplication.UnicodeUTF8))
 
     def setup_right_bottom(self, Form):
         Form.setObjectName("right_bottom")
@@ -234,18 +238,29 @@ class MainWindow(QtGui.QMainWindow):
         self.friends_list.setVerticalScrollMode(QtGui.QAbstractItemView.ScrollPerPixel)
 
     def setup_right_center(self, widget):
-        self.messages = QtGui.QListWidget(widget)
-        self.messages.setGeometry(0, 0, 620, 250)
-        self.messages.setObjectName("messages")
-        self.messages.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
-        self.messages.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
-
-        def load(pos):
-            if not pos:
+        self.messages_widget = widget
+        self.messages = self.create_messages_list()
+
+    def create_messages_list(self):
+        """
+        Method-factory
+        :return: new list for messages of one conversation
+        """
+        messages = QtGui.QListWidget(self.messages_widget)
+        messages.setGeometry(0, 0, 620, 250)
+        messages.setObjectName("messages")
+        messages.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
+        messages.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+
+        def load(pos):  # load next part of messages before scrollbar reaches top or bottom
+            scroll = messages.verticalScrollBar()
+            if pos < scroll.pageStep():
                 self.profile.load_history()
-                self.messages.verticalScrollBar().setValue(1)
-        self.messages.verticalScrollBar().valueChanged.connect(load)
-        self.messages.setVerticalScrollMode(QtGui.QAbstractItemView.ScrollPerPixel)
+            elif pos > scroll.maximum() - scroll.pageStep():
+                self.profile.load_newer_history()
+        messages.verticalScrollBar().valueChanged.connect(load)
+        messages.setVerticalScrollMode(QtGui.QAbstractItemView.ScrollPerPixel)
+        return messages
 
     def initUI(self, tox):
         self.setMinimumSize(920, 500)
@@ -285,9 +300,22 @@ class MainWindow(QtGui.QMainWindow):
         self.retranslateUi()
 
     def closeEvent(self, *args, **kwargs):
+        self.close_profile()
+        QtGui.QApplication.closeAllWindows()
+
+    def close_profile(self):
         self.profile.save_history()
         self.profile.close()
-        QtGui.QApplication.closeAllWindows()
+        clear_main_thread_calls()  # calls queued by tox threads are for closed profile
+
+    def open_profile(self, tox):
+        """
+        Show new profile in this window
+        :param tox: tox instance of new profile
+        """
+        self.profile.close_chat_views()
+        self.friends_list.clear()
+        self.profile = Profile(tox, self)
 
     # -----------------------------------------------------------------------------------------------------------------
     # Functions which called when user click in menu
@@ -308,6 +336,45 @@ class MainWindow(QtGui.QMainWindow):
         self.a_c = AddContact()
         self.a_c.show()
 
+    def switch_profile(self):
+        profiles = ProfileHelper.find_profiles()
+        self.login = LoginScreen()
+        self.login.setWindowIconText("Toxygen")
+        self.login.update_select(map(lambda x: x[1], profiles))
+
+        def login_screen_close(t, number=-1, default=False, name=None):
+            if t == 1:  # create new profile
+                data = (Settings.get_default_path(), name or 'toxygen_user', True)
+            elif t == 2:  # load existing profile
+                data = profiles[number] + (False, )
+                if default:
+                    Settings.set_auto_profile(*profiles[number])
+            else:
+                return
+            QtCore.QTimer.singleShot(0, lambda: self.load_profile(*data))  # when login screen is closed
+        self.login.update_on_close(login_screen_close)
+        self.login.show()
+
+    def load_profile(self, path, name, create):
+        """
+        :param path: directory of profile
+        :param name: name of profile
+        :param create: create new profile
+        """
+        if not create:
+            if ProfileHelper.get_path() == path.decode(locale.getpreferredencoding()) and \
+                    Settings.get_instance().name == name:
+                return  # current profile
+            if ProfileHelper.is_active_profile(path, name):  # profile is in use
+                reply = QtGui.QMessageBox.question(None,
+                                                   'Profile {}'.format(name),
+                                                   QtGui.QApplication.translate("login", 'Looks like other instance of Toxygen uses this profile! Continue?', None, QtGui.QApplication.UnicodeUTF8),
+                                                   QtGui.QMessageBox.Yes,
+                                                   QtGui.QMessageBox.No)
+                if reply != QtGui.QMessageBox.Yes:
+                    return
+        self.profile_switcher(path, name, create)
+
     def profile_settings(self, *args):
         self.p_s = ProfileSettings()
         self.p_s.show()
@@ -17,11 +17,14 @@ class AddContact(CenteredWidget):
         self.setObjectName('AddContact')
         self.resize(568, 306)
         self.sendRequestButton = QtGui.QPushButton(self)
-        self.sendRequestButton.setGeometry(QtCore.QRect(50, 270, 471, 31))
+        self.sendRequestButton.setGeometry(QtCore.QRect(210, 270, 311, 31))
         self.sendRequestButton.setMinimumSize(QtCore.QSize(0, 0))
         self.sendRequestButton.setBaseSize(QtCore.QSize(0, 0))
         self.sendRequestButton.setObjectName("sendRequestButton")
         self.sendRequestButton.clicked.connect(self.add_friend)
+        self.importButton = QtGui.QPushButton(self)
+        self.importButton.setGeometry(QtCore.QRect(50, 270, 150, 31))
+        self.importButton.clicked.connect(self.import_friends)
         self.tox_id = QtGui.QLineEdit(self)
         self.tox_id.setGeometry(QtCore.QRect(50, 40, 471, 27))
         self.tox_id.setObjectName("lineEdit")
@@ -52,7 +55,12 @@ class AddContact(CenteredWidget):
 
     def add_friend(self):
         profile = Profile.get_instance()
-        send = profile.send_friend_request(self.tox_id.text(), self.message_edit.toPlainText())
+        profile.send_friend_request(self.tox_id.text(), self.message_edit.toPlainText(), self.request_sent)
+
+    def request_sent(self, send):
+        """
+        :param send: True if request was sent else error string
+        """
         if send is True:
             # request was successful
             self.close()
@@ -61,9 +69,33 @@ class AddContact(CenteredWidget):
                 send = send[:40] + '...'
             self.error_label.setText(send)
 
+    def import_friends(self):
+        choose = QtGui.QApplication.translate("AddContact", "Choose file with TOX IDs", None, QtGui.QApplication.UnicodeUTF8)
+        name = QtGui.QFileDialog.getOpenFileName(self, choose)
+        if not name[0]:
+            return
+        profile = Profile.get_instance()
+        profile.import_friends(name[0], self.message_edit.toPlainText(), AddContact.show_import_report)
+        self.close()
+
+    @staticmethod
+    def show_import_report(report):
+        """
+        :param report: list of tuples (line, error)
+        """
+        errors = filter(lambda x: x[1] is not None, report)
+        text = QtGui.QApplication.translate("AddContact", "Friend requests sent: {}. Failed: {}.", None, QtGui.QApplication.UnicodeUTF8)
+        msgBox = QtGui.QMessageBox()
+        msgBox.setWindowTitle(QtGui.QApplication.translate("AddContact", "Import contacts", None, QtGui.QApplication.UnicodeUTF8))
+        msgBox.setText(text.format(len(report) - len(errors), len(errors)))
+        if errors:
+            msgBox.setDetailedText(u'\n'.join(u'{}: {}'.format(line, error) for line, error in errors))
+        msgBox.exec_()
+
     def retranslateUi(self):
         self.setWindowTitle(QtGui.QApplication.translate('AddContact', "Add contact", None, QtGui.QApplication.UnicodeUTF8))
         self.sendRequestButton.setText(QtGui.QApplication.translate("Form", "Send request", None, QtGui.QApplication.UnicodeUTF8))
+        self.importButton.setText(QtGui.QApplication.translate("AddContact", "Import from file", None, QtGui.QApplication.UnicodeUTF8))
         self.label.setText(QtGui.QApplication.translate('AddContact', "TOX ID:", None, QtGui.QApplication.UnicodeUTF8))
         self.label_2.setText(QtGui.QApplication.translate('AddContact', "Message:", None, QtGui.QApplication.UnicodeUTF8))
 
@@ -146,12 +178,10 @@ class ProfileSettings(CenteredWidget):
         Profile.get_instance().reset_avatar()
 
     def set_avatar(self):
-        name = QtGui.QFileDialog.getOpenFileName(self, 'Open file', None, 'Image Files (*.png)')
+        name = QtGui.QFileDialog.getOpenFileName(self, 'Open file', None, 'Image Files (*.png *.jpg *.jpeg *.bmp *.gif)')
         print name
         if name[0]:
-            with open(name[0], 'rb') as f:
-                data = f.read()
-            Profile.get_instance().set_avatar(data)
+            Profile.get_instance().set_avatar_from_file(name[0])
 
     def export_profile(self):
         directory = QtGui.QFileDialog.getExistingDirectory() + '/'
@@ -444,6 +474,9 @@ class InterfaceSettings(CenteredWidget):
         self.lang = QtGui.QLabel(self)
         self.lang.setGeometry(QtCore.QRect(30, 110, 121, 31))
         self.lang.setFont(font)
+        self.sort_by_activity = QtGui.QCheckBox(self)
+        self.sort_by_activity.setGeometry(QtCore.QRect(30, 200, 240, 30))
+        self.sort_by_activity.setChecked(settings['sort_friends_by_activity'])
         self.retranslateUi()
         QtCore.QMetaObject.connectSlotsByName(self)
 
@@ -451,6 +484,7 @@ class InterfaceSettings(CenteredWidget):
         self.setWindowTitle(QtGui.QApplication.translate("interfaceForm", "Interface settings", None, QtGui.QApplication.UnicodeUTF8))
         self.label.setText(QtGui.QApplication.translate("interfaceForm", "Theme:", None, QtGui.QApplication.UnicodeUTF8))
         self.lang.setText(QtGui.QApplication.translate("interfaceForm", "Language:", None, QtGui.QApplication.UnicodeUTF8))
+        self.sort_by_activity.setText(QtGui.QApplication.translate("interfaceForm", "Sort contacts by activity", None, QtGui.QApplication.UnicodeUTF8))
 
     def closeEvent(self, event):
         settings = Settings.get_instance()
@@ -466,6 +500,11 @@ class InterfaceSettings(CenteredWidget):
             app.removeTranslator(app.translator)
             app.translator.load(curr_directory() + '/translations/' + path)
             app.installTranslator(app.translator)
+        if settings['sort_friends_by_activity'] != self.sort_by_activity.isChecked():
+            settings['sort_friends_by_activity'] = self.sort_by_activity.isChecked()
+            profile = Profile.get_instance()
+            if profile.is_loaded():  # otherwise list will be sorted when loading is finished
+                profile.set_friends_sorting(settings['sort_friends_by_activity'])
         settings.save()
 
 
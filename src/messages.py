@@ -1,3 +1,4 @@
+from PySide import QtCore
 
 
 MESSAGE_TYPE = {
@@ -16,6 +17,17 @@ FILE_TRANSFER_MESSAGE_STATUS = {
 }
 
 
+MESSAGE_STATUS = {
+    'DELIVERED': 0,
+    'PENDING': 1,
+    'SENT': 2
+}
+
+
+class StatusSignal(QtCore.QObject):
+    signal = QtCore.Signal(int)
+
+
 class Message(object):
 
     def __init__(self, message_type, owner, time):
@@ -35,9 +47,30 @@ class TextMessage(Message):
     Plain text or action message
     """
 
-    def __init__(self, message, owner, time, message_type):
+    def __init__(self, message, owner, time, message_type, status=MESSAGE_STATUS['DELIVERED']):
         super(TextMessage, self).__init__(message_type, owner, time)
         self._message = message
+        self._status = status
+        self._status_changed = None
+
+    def get_status(self):
+        return self._status
+
+    def set_status(self, value):
+        """
+        Can be called from any thread, handler is called in main thread
+        """
+        self._status = value
+        if self._status_changed is not None:
+            self._status_changed.signal.emit(value)
+
+    def set_status_handler(self, handler):
+        """
+        :param handler: function which gets new status, called in main thread. Must be set in main thread
+        """
+        if self._status_changed is None:
+            self._status_changed = StatusSignal()
+        self._status_changed.signal.connect(handler)
 
     def get_data(self):
         return self._message, self._owner, self._time, self._type
@@ -0,0 +1,147 @@
+from collections import deque, OrderedDict
+from ctypes import ArgumentError
+from toxcore_enums_and_consts import TOX_MAX_MESSAGE_LENGTH
+from util import log, Singleton, wake_scheduler
+import threading
+
+
+MAX_CHUNKS_PER_ITERATION = 8  # max count of chunks sent to one friend per tox iteration
+
+SEPARATORS = ('\n', ' ', ',', '.')  # message is split after them, first ones are preferred
+
+MIN_CHUNK_PART = 4. / 5  # chunk is split on separator only if it's in last part of chunk
+
+
+def split_message(message, size=TOX_MAX_MESSAGE_LENGTH):
+    """
+    Split message to chunks in one pass. Chunks end after separator if there is one near the end of chunk,
+    multibyte characters are never split
+    :param message: utf-8 encoded message
+    :param size: max size of chunk in bytes
+    :return: generator of chunks, empty message has no chunks
+    """
+    start, length = 0, len(message)
+    while length - start > size:
+        end = start + size
+        lower = start + int(size * MIN_CHUNK_PART)
+        for separator in SEPARATORS:
+            index = message.rfind(separator, lower, end)
+            if index != -1:
+                end = index + 1
+                break
+        else:
+            while end > start + 1 and (ord(message[end]) & 0xC0) == 0x80:  # continuation byte of character
+                end -= 1
+        yield message[start:end]
+        start = end
+    if start < length:
+        yield message[start:]
+
+
+class OutgoingMessage(object):
+    """
+    Message which is sent by chunks. Tracks ids of chunks which friend didn't receive yet
+    """
+
+    def __init__(self, message_type, chunks, on_sent, on_delivered):
+        self.message_type = message_type
+        self.chunks = chunks
+        self.chunk = next(chunks, None)  # chunk which will be sent next
+        self.unacknowledged = set()
+        self.on_sent, self.on_delivered = on_sent, on_delivered
+
+
+class OutgoingQueue(Singleton):
+    """
+    Per friend queues of outgoing messages. Chunks of messages are taken lazily and sent from tox iterate thread.
+    If toxcore can't accept chunk (send queue is full or friend is offline) it's retried on next iteration, so
+    order of chunks is preserved and long messages are sent at speed of connection.
+    Ids of sent chunks are indexed until friend's read receipts are received
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # key - friend number, value - deque of OutgoingMessage
+        self._receipts = {}  # key - tuple (friend number, message id), value - OutgoingMessage
+
+    def put(self, friend_number, message_type, chunks, on_sent=None, on_delivered=None):
+        """
+        Add message to queue
+        :param friend_number: number of friend
+        :param message_type: type of message
+        :param chunks: iterable of parts of message (strings no longer than TOX_MAX_MESSAGE_LENGTH)
+        :param on_sent: function called in tox iterate thread when all chunks were sent
+        :param on_delivered: function called in tox iterate thread when friend received all chunks
+        """
+        message = OutgoingMessage(message_type, iter(chunks), on_sent, on_delivered)
+        if message.chunk is None:  # nothing to send
+            return
+        with self._lock:
+            self._queues.setdefault(friend_number, deque()).append(message)
+        wake_scheduler()
+
+    def remove(self, friend_number):
+        """
+        Drop unsent messages of friend and forget ids of messages without receipts
+        """
+        with self._lock:
+            self._queues.pop(friend_number, None)
+            for key in filter(lambda x: x[0] == friend_number, self._receipts.keys()):
+                del self._receipts[key]
+
+    def is_empty(self, friend_number):
+        with self._lock:
+            return not self._queues.get(friend_number)
+
+    def drain(self, tox):
+        """
+        Send queued chunks. Called in tox iterate thread after each iteration
+        :param tox: Tox instance
+        """
+        with self._lock:
+            friends = self._queues.keys()
+        for friend_number in friends:
+            for _ in xrange(MAX_CHUNKS_PER_ITERATION):
+                with self._lock:
+                    queue = self._queues.get(friend_number)
+                    if not queue:
+                        self._queues.pop(friend_number, None)
+                        break
+                    message = queue[0]
+                try:
+                    message_id = tox.friend_send_message(friend_number, message.message_type, message.chunk)
+                except RuntimeError:  # send queue is full or friend is offline, retry later
+                    break
+                except ArgumentError as ex:  # chunk can't be sent
+                    log('Message was not sent: ' + str(ex))
+                    message_id = None
+                message.chunk = next(message.chunks, None)
+                with self._lock:
+                    if self._queues.get(friend_number) is not queue:  # queue was removed while chunk was sent
+                        break
+                    if message_id is not None:
+                        message.unacknowledged.add(message_id)
+                        self._receipts[(friend_number, message_id)] = message
+                    if message.chunk is not None:
+                        continue
+                    queue.popleft()
+                    delivered = not message.unacknowledged
+                if message.on_sent is not None:
+                    message.on_sent()
+                if delivered and message.on_delivered is not None:
+                    message.on_delivered()
+
+    def receipt(self, friend_number, message_id):
+        """
+        Friend received chunk. Called in tox iterate thread
+        :param friend_number: number of friend
+        :param message_id: id returned by friend_send_message
+        """
+        with self._lock:
+            message = self._receipts.pop((friend_number, message_id), None)
+            if message is None:
+                return
+            message.unacknowledged.discard(message_id)
+            delivered = message.chunk is None and not message.unacknowledged
+        if delivered and message.on_delivered is not None:
+            message.on_delivered()
@@ -1,4 +1,4 @@
-from list_items import MessageItem, ContactItem, FileTransferItem, InlineImageItem
+from list_items import MessageItem, ContactItem, ContactListItem, FileTransferItem, InlineImageItem
 from PySide import QtCore, QtGui
 from tox import Tox
 import os
@@ -6,13 +6,29 @@ from messages import *
 from settings import *
 from toxcore_enums_and_consts import *
 from ctypes import *
-from util import curr_time, log, Singleton, curr_directory, convert_time
+from util import curr_time, log, Singleton, curr_directory, convert_time, LRUCache
 from tox_dns import tox_dns
 from history import *
 from file_transfers import *
 import time
 import calls
+from bisect import bisect_left
 import avwidgets
+from chat_view import ChatView, CHAT_VIEWS_CACHE_SIZE
+from contact_search import ContactSearchIndex
+from friends_import import FriendsImport
+from outgoing_queue import OutgoingQueue, split_message
+from typing_notifications import TypingNotifications
+from flood_control import FloodControl
+from tox_commands import ToxCommands
+from avatars import AvatarCache, SentAvatars, AvatarOptimizer, open_avatar_store
+from avatar_store import AvatarStore
+import json
+
+
+FRIENDS_BATCH_SIZE = 16  # count of friends created or synced with toxcore per event loop iteration
+
+MAX_TEXT_MESSAGE_SIZE = 16 * 1024  # longer texts are sent as compressed files
 
 
 class Contact(object):
@@ -94,27 +110,20 @@ class Contact(object):
         """
         Tries to load avatar of contact or uses default avatar
         """
-        avatar_path = '{}.png'.format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-        os.chdir(ProfileHelper.get_path() + 'avatars/')
-        if not os.path.isfile(avatar_path):  # load default image
-            avatar_path = 'avatar.png'
-            os.chdir(curr_directory() + '/images/')
-        pixmap = QtGui.QPixmap(QtCore.QSize(64, 64))
-        pixmap.load(avatar_path)
         self._widget.avatar_label.setScaledContents(False)
-        self._widget.avatar_label.setPixmap(pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio))
+        self._widget.avatar_label.setPixmap(AvatarCache.get_pixmap(self._tox_id))
         self._widget.avatar_label.repaint()
 
     def reset_avatar(self):
-        avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-        if os.path.isfile(avatar_path):
-            os.remove(avatar_path)
+        store = AvatarStore.get_instance()
+        if self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2] in store:
+            store.remove(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
+            AvatarCache.invalidate(self._tox_id)
             self.load_avatar()
 
     def set_avatar(self, avatar):
-        avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-        with open(avatar_path, 'wb') as f:
-            f.write(avatar)
+        AvatarStore.get_instance().set(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2], avatar, Tox.hash(avatar))
+        AvatarCache.invalidate(self._tox_id)
         self.load_avatar()
 
     def get_pixmap(self):
@@ -128,7 +137,7 @@ class Friend(Contact):
 
     def __init__(self, message_getter, number, *args):
         """
-        :param message_getter: gets messages from db
+        :param message_getter: gets messages from db, None if it will be set later
         :param number: number of friend.
         """
         super(Friend, self).__init__(*args)
@@ -136,7 +145,9 @@ class Friend(Contact):
         self._new_messages = False
         self._visible = True
         self._alias = False
-        self._message_getter = message_getter
+        if message_getter is not None:
+            self._message_getter = message_getter
+        self._last_activity = 0  # unix time of last message
         self._corr = []
         self._unsaved_messages = 0
         self._history_loaded = False
@@ -163,9 +174,12 @@ class Friend(Contact):
         else:
             return
         data = map(lambda tupl: TextMessage(*tupl), data)
-        self._corr = data + self._corr
+        self._corr[:0] = data
         self._history_loaded = True
 
+    def set_message_getter(self, message_getter):
+        self._message_getter = message_getter
+
     def get_corr_for_saving(self):
         """
         Get data to save in db
@@ -179,6 +193,19 @@ class Friend(Contact):
     def get_corr(self):
         return self._corr[:]
 
+    def get_corr_page(self, offset, count):
+        """
+        Get part of messages. Loads older messages from db if needed
+        :param offset: count of newest messages which should be skipped
+        :param count: max count of messages in page
+        :return: list of messages in chronological order
+        """
+        end = len(self._corr) - offset
+        if end < count:
+            self.load_corr(False)
+            end = len(self._corr) - offset
+        return self._corr[max(end - count, 0):max(end, 0)]
+
     def append_message(self, message):
         """
         :param message: tuple (message, owner, unix_time, message_type)
@@ -186,6 +213,7 @@ class Friend(Contact):
         self._corr.append(message)
         if message.get_type() <= 1:
             self._unsaved_messages += 1
+            self._last_activity = time.time()
 
     def get_last_message_text(self):
         messages = filter(lambda x: x.get_type() <= 1 and not x.get_owner(), self._corr)
@@ -276,6 +304,25 @@ class Friend(Contact):
 
     number = property(get_number, set_number)
 
+    # -----------------------------------------------------------------------------------------------------------------
+    # Position in friends list sorted by activity
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get_last_activity(self):
+        return self._last_activity
+
+    def set_last_activity(self, value):
+        self._last_activity = value
+
+    last_activity = property(get_last_activity, set_last_activity)
+
+    def get_sort_key(self):
+        """
+        :return: key of friend in friends list sorted by activity. Online friends go first, then friends with
+        unread messages, then friends with most recent messages
+        """
+        return ((self._status is not None) * 2 + bool(self._new_messages)) * 2. ** 32 + self._last_activity
+
 
 class Profile(Contact, Singleton):
     """
@@ -286,39 +333,323 @@ class Profile(Contact, Singleton):
         :param tox: tox instance
         :param screen: ref to main screen
         """
+        open_avatar_store()
         super(Profile, self).__init__(tox.self_get_name(),
                                       tox.self_get_status_message(),
                                       screen.user_info,
                                       tox.self_get_address())
         self._screen = screen
         self._messages = screen.messages
+        self._empty_view = self._active_view = ChatView(screen.messages)
+        self._views = LRUCache(CHAT_VIEWS_CACHE_SIZE, lambda number, view: view.close())  # key - friend number
         self._tox = tox
         self._file_transfers = {}  # dict of file transfers. key - tuple (friend_number, file_number)
         self._call = calls.AV(tox.AV)  # object with data about calls
+        self._avatar_data = None  # tuple (avatar data, hash) shared by avatar transfers
+        self._avatar_optimizer = None
+        self._friends_import = None
+        self._imports = []  # arguments of imports of friends which will be started when current one is finished
         self._incoming_calls = set()
         settings = Settings.get_instance()
         self._show_online = settings['show_online_friends']
         screen.online_contacts.setChecked(self._show_online)
-        aliases = settings['friends_aliases']
-        data = tox.self_get_friend_list()
+        self._aliases = dict(settings['friends_aliases'])
         self._history = History(tox.self_get_public_key())  # connection to db
+        SentAvatars()  # hashes of avatars which friends have
         self._friends, self._active_friend = [], -1
-        for i in data:  # creates list of friends
-            tox_id = tox.friend_get_public_key(i)
-            if not self._history.friend_exists_in_db(tox_id):
-                self._history.add_friend_to_db(tox_id)
-            try:
-                alias = filter(lambda x: x[0] == tox_id, aliases)[0][1]
-            except:
-                alias = ''
-            item = self.create_friend_item()
-            name = alias or tox.friend_get_name(i) or tox_id
-            status_message = tox.friend_get_status_message(i)
-            message_getter = self._history.messages_getter(tox_id)
-            friend = Friend(message_getter, i, name, status_message, item, tox_id)
-            friend.set_alias(alias)
-            self._friends.append(friend)
+        self._rows = {}  # key - friend's number, value - row of friend in friends list
+        self._sort_keys = []  # negated sort keys of rows, ascending when friends list is sorted by activity
+        self._search_index = ContactSearchIndex()  # key - friend number
+        OutgoingQueue()  # unsent messages
+        TypingNotifications()
+        FloodControl()  # incoming messages
+        ToxCommands()  # calls to toxcore from main thread
+        self._pending_messages = {}  # key - id of pending message in db, value - TextMessage
+        self._drafts = dict(settings['drafts'])  # key - public key, value - text of unsent message
+        self._session_friend = settings['active_friend']  # public key of friend who was active on last exit
+        self._session_unread = set(settings['unread_friends'])
+        self._prefetch = []  # friends whose chats will be rendered in background
+        self._not_loaded = list(tox.self_get_friend_list())  # numbers of friends which are not created yet
+        self._not_synced = []  # friends created from contacts snapshot without live data
+        self._not_restored = []  # friends of first screen created with live data, their session is not restored
+        self._loaded_callbacks = []
+        self._snapshot = self.load_contacts_snapshot()
+        for number in self._not_loaded[:FRIENDS_BATCH_SIZE]:  # first screen of friends list
+            if number in self._snapshot and self._snapshot[number][0] == tox.friend_get_public_key(number):
+                tox_id, name, status_message, last_activity = self._snapshot[number]
+                friend = Friend(None, number, name, status_message, self.create_friend_item(), tox_id)
+                friend.last_activity = last_activity
+                self._not_synced.append(friend)
+            else:
+                friend = self.create_friend(number)
+                self._not_restored.append(friend)
+            self.append_friend(friend)
+            self.index_friend(friend)
+        del self._not_loaded[:FRIENDS_BATCH_SIZE]
         self.filtration(self._show_online)
+        QtCore.QTimer.singleShot(0, self.load_friends_batch)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Progressive loading of friends list
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def create_friend(self, number):
+        """
+        Create friend using live data from toxcore and db
+        :param number: friend's number
+        :return: Friend instance
+        """
+        tox_id = self._tox.friend_get_public_key(number)
+        if not self._history.friend_exists_in_db(tox_id):
+            self._history.add_friend_to_db(tox_id)
+        alias = self._aliases.get(tox_id, '')
+        item = self.create_friend_item()
+        name = alias or self._tox.friend_get_name(number) or tox_id
+        status_message = self._tox.friend_get_status_message(number)
+        message_getter = self._history.messages_getter(tox_id)
+        friend = Friend(message_getter, number, name, status_message, item, tox_id)
+        friend.set_alias(alias)
+        if number in self._snapshot and self._snapshot[number][0] == tox_id:
+            friend.last_activity = self._snapshot[number][3]
+        return friend
+
+    def sync_friend(self, friend):
+        """
+        Replace data from contacts snapshot with live data
+        :param friend: Friend instance created from snapshot
+        """
+        if not self._history.friend_exists_in_db(friend.tox_id):
+            self._history.add_friend_to_db(friend.tox_id)
+        alias = self._aliases.get(friend.tox_id, '')
+        friend.set_alias(alias)
+        if not alias:
+            friend.name = self._tox.friend_get_name(friend.number) or friend.tox_id
+        friend.status_message = self._tox.friend_get_status_message(friend.number)
+        friend.set_message_getter(self._history.messages_getter(friend.tox_id))
+        self.index_friend(friend)
+        if friend.number in self._views:  # chat was opened before, it was rendered without history
+            self.drop_chat_view(friend.number)
+            if friend.number == self.get_active_number():
+                self.show_chat_view(friend)
+
+    def load_friends_batch(self):
+        """
+        Sync or create next batch of friends. Called once per event loop iteration until all friends are loaded
+        """
+        if not hasattr(self, '_history'):  # profile was closed
+            return
+        for friend in self._not_restored:
+            self.restore_friend_session(friend)
+        self._not_restored = []
+        for friend in self._not_synced[:FRIENDS_BATCH_SIZE]:
+            self.sync_friend(friend)
+            self.restore_friend_session(friend)
+        count = FRIENDS_BATCH_SIZE - len(self._not_synced[:FRIENDS_BATCH_SIZE])
+        del self._not_synced[:FRIENDS_BATCH_SIZE]
+        for number in self._not_loaded[:count]:
+            friend = self.create_friend(number)
+            self.append_friend(friend)
+            self.index_friend(friend)
+            self.restore_friend_session(friend)
+        del self._not_loaded[:count]
+        self.update_filtration()
+        if self._not_synced or self._not_loaded:
+            QtCore.QTimer.singleShot(0, self.load_friends_batch)
+        else:
+            del self._snapshot
+            self.set_friends_sorting(Settings.get_instance()['sort_friends_by_activity'])
+            self.save_contacts_snapshot()
+            self._prefetch = [item for item in self._friends if item.messages]
+            QtCore.QTimer.singleShot(0, self.prefetch_chat_views)
+            callbacks, self._loaded_callbacks = self._loaded_callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def is_loaded(self):
+        return not (self._not_synced or self._not_loaded)
+
+    def on_loaded(self, callback):
+        """
+        :param callback: function called when all friends are loaded. Called immediately if they already are
+        """
+        if self.is_loaded():
+            callback()
+        else:
+            self._loaded_callbacks.append(callback)
+
+    def load_contacts_snapshot(self):
+        """
+        Load names and status messages of friends saved on last exit
+        :return: dict. Key - friend's number, value - tuple (tox id, name, status message, last activity)
+        """
+        path = ProfileStorage.get_instance().get_contacts_snapshot_path()
+        if os.path.isfile(path):
+            try:
+                with open(path) as fl:
+                    data = json.loads(fl.read())
+                return dict((item[0], (str(item[1]), item[2], item[3], item[4] if len(item) > 4 else 0))
+                            for item in data)
+            except Exception as ex:
+                log('Contacts snapshot is broken: ' + str(ex))
+        return {}
+
+    def save_contacts_snapshot(self):
+        """
+        Save names and status messages of friends. Used for fast painting of friends list on next start
+        """
+        if not self.is_loaded():
+            return
+        data = [[friend.number, friend.tox_id, friend.name, friend.status_message, friend.last_activity]
+                for friend in self._friends]
+        try:
+            with open(ProfileStorage.get_instance().get_contacts_snapshot_path(), 'w') as fl:
+                fl.write(json.dumps(data))
+        except Exception as ex:
+            log('Contacts snapshot was not saved: ' + str(ex))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Session restore
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def restore_friend_session(self, friend):
+        """
+        Restore unread messages flag of new friend and open chat with friend if it was active on last exit.
+        Called from load_friends_batch when friend has live data and access to history
+        :param friend: Friend instance which was added to friends list
+        """
+        if friend.tox_id in self._session_unread:
+            friend.set_messages(True)
+        if friend.tox_id == self._session_friend:
+            self._session_friend = None
+            self.set_active(self._rows[friend.number])
+            QtCore.QTimer.singleShot(0, self.restore_chat_scroll)  # when list has actual size
+
+    def restore_chat_scroll(self):
+        """
+        Restore scroll position of chat which was active on last exit
+        """
+        self._messages.doItemsLayout()
+        scroll = self._messages.verticalScrollBar()
+        scroll.setValue(scroll.maximum() - Settings.get_instance()['active_chat_scroll'])
+
+    def prefetch_chat_views(self):
+        """
+        Render chats with unread messages in background, one chat per event loop iteration.
+        Chats are prefetched only while there is free space in views cache
+        """
+        while self._prefetch and len(self._views) < CHAT_VIEWS_CACHE_SIZE:
+            friend = self._prefetch.pop(0)
+            if friend in self._friends and friend.number not in self._views:
+                self.create_chat_view(friend)
+                QtCore.QTimer.singleShot(0, self.prefetch_chat_views)
+                return
+        self._prefetch = []
+
+    def save_draft(self):
+        """
+        Save unsent message of active friend
+        """
+        if self._active_friend >= 0:
+            text = self._screen.messageEdit.toPlainText()
+            tox_id = self._friends[self._active_friend].tox_id
+            if text:
+                self._drafts[tox_id] = text
+            else:
+                self._drafts.pop(tox_id, None)
+
+    def save_session(self):
+        """
+        Save active friend, scroll position of active chat, unsent messages and friends with unread messages
+        """
+        if not self.is_loaded():
+            return
+        self.save_draft()
+        settings = Settings.get_instance()
+        settings['drafts'] = self._drafts
+        settings['unread_friends'] = [friend.tox_id for friend in self._friends if friend.messages]
+        if self._active_friend >= 0:
+            settings['active_friend'] = self._friends[self._active_friend].tox_id
+            scroll = self._messages.verticalScrollBar()
+            settings['active_chat_scroll'] = scroll.maximum() - scroll.value() if not self._active_view.newer else 0
+        else:
+            settings['active_friend'], settings['active_chat_scroll'] = None, 0
+        settings.save()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Sorting of friends list
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def set_friends_sorting(self, by_activity):
+        """
+        Sort friends list by activity or restore order from profile
+        :param by_activity: sort by activity and keep list sorted when friends' state changes
+        """
+        friends_list = self._screen.friends_list
+        for index, friend in enumerate(self._friends):
+            item = friends_list.item(index)
+            item.setData(ContactListItem.NUMBER_ROLE, friend.number)
+            item.setData(ContactListItem.SORT_KEY_ROLE, friend.get_sort_key() if by_activity else -friend.number)
+        friends_list.setSortingEnabled(by_activity)
+        friends_list.sortItems()
+        self.sync_friends_order()
+
+    def sync_friends_order(self):
+        """
+        Reorder list of friends as rows of friends list widget
+        """
+        friends_list = self._screen.friends_list
+        active = self._friends[self._active_friend] if self._active_friend >= 0 else None
+        friends = dict((friend.number, friend) for friend in self._friends)
+        self._friends = [friends[friends_list.item(i).data(ContactListItem.NUMBER_ROLE)]
+                         for i in xrange(friends_list.count())]
+        self._sort_keys = [-friends_list.item(i).data(ContactListItem.SORT_KEY_ROLE)
+                           for i in xrange(friends_list.count())]
+        self.update_rows()
+        if active is not None:
+            self._active_friend = self._rows[active.number]
+
+    def update_friend_position(self, friend):
+        """
+        Move friend to new position in sorted friends list. Row is found by binary search in list of sort keys,
+        Qt finds the same position and moves only this row. Only rows between old and new position are updated
+        :param friend: Friend instance which state was changed
+        """
+        row = self._rows.get(friend.number)
+        if row is None or self._friends[row] is not friend:  # friend was deleted
+            return
+        friends_list = self._screen.friends_list
+        item = friends_list.item(row)
+        item.setData(ContactListItem.NUMBER_ROLE, friend.number)
+        key = friend.get_sort_key()
+        if not friends_list.isSortingEnabled() or self._sort_keys[row] == -key:
+            return
+        del self._friends[row], self._sort_keys[row]
+        new_row = bisect_left(self._sort_keys, -key)
+        self._friends.insert(new_row, friend)
+        self._sort_keys.insert(new_row, -key)
+        for index in xrange(min(row, new_row), max(row, new_row) + 1):
+            self._rows[self._friends[index].number] = index
+        if self._active_friend == row:
+            self._active_friend = new_row
+        elif row < self._active_friend <= new_row:
+            self._active_friend -= 1
+        elif new_row <= self._active_friend < row:
+            self._active_friend += 1
+        item.setData(ContactListItem.SORT_KEY_ROLE, key)
+        if friends_list.item(new_row) is not item:  # Qt chose other position among equal keys
+            self.sync_friends_order()
+
+    def append_friend(self, friend):
+        """
+        Add friend to the end of friends list. Its row has ContactListItem.NEW_ROW_SORT_KEY
+        :param friend: Friend instance
+        """
+        self._rows[friend.number] = len(self._friends)
+        self._friends.append(friend)
+        self._sort_keys.append(-ContactListItem.NEW_ROW_SORT_KEY)
+
+    def update_rows(self):
+        self._rows = dict((friend.number, index) for index, friend in enumerate(self._friends))
 
     # -----------------------------------------------------------------------------------------------------------------
     # Edit current user's data
@@ -331,15 +662,15 @@ class Profile(Contact, Singleton):
         if self._status is not None:
             status = (self._status + 1) % 3
             super(self.__class__, self).set_status(status)
-            self._tox.self_set_status(status)
+            ToxCommands.get_instance().call(self._tox.self_set_status, status)
 
     def set_name(self, value):
         super(self.__class__, self).set_name(value)
-        self._tox.self_set_name(self._name.encode('utf-8'))
+        ToxCommands.get_instance().call(self._tox.self_set_name, self._name.encode('utf-8'))
 
     def set_status_message(self, value):
         super(self.__class__, self).set_status_message(value)
-        self._tox.self_set_status_message(self._status_message.encode('utf-8'))
+        ToxCommands.get_instance().call(self._tox.self_set_status_message, self._status_message.encode('utf-8'))
 
     # -----------------------------------------------------------------------------------------------------------------
     # Filtration
@@ -347,21 +678,29 @@ class Profile(Contact, Singleton):
 
     def filtration(self, show_online=True, filter_str=''):
         """
-        Filtration of friends list
+        Filtration of friends list. Only rows which visibility was changed are updated,
+        list is scrolled to the best match
         :param show_online: show online only contacts
-        :param filter_str: show contacts which name contains this substring
+        :param filter_str: show contacts which name, alias, status message or public key match this string
         """
-        filter_str = filter_str.lower()
+        matches = self._search_index.search(filter_str) if filter_str.strip() else []
+        found = set(matches) if filter_str.strip() else None
+        rows = {}  # key - number of found friend, value - row
         for index, friend in enumerate(self._friends):
-            friend.visibility = (friend.status is not None or not show_online) and (filter_str in friend.name.lower())
-            if friend.visibility:
-                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, 70))
-            else:
-                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, 0))
+            visible = (friend.status is not None or not show_online) and (found is None or friend.number in found)
+            if visible != friend.visibility:
+                friend.visibility = visible
+                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, 70 if visible else 0))
+            if visible and found:
+                rows[friend.number] = index
+        best = next((rows[number] for number in matches if number in rows), None)
+        if best is not None:
+            self._screen.friends_list.scrollToItem(self._screen.friends_list.item(best))
+        if self._show_online != show_online:
+            settings = Settings.get_instance()
+            settings['show_online_friends'] = show_online
+            settings.save()
         self._show_online, self._filter_string = show_online, filter_str
-        settings = Settings.get_instance()
-        settings['show_online_friends'] = self._show_online
-        settings.save()
 
     def update_filtration(self):
         """
@@ -369,6 +708,14 @@ class Profile(Contact, Singleton):
         """
         self.filtration(self._show_online, self._filter_string)
 
+    def index_friend(self, friend):
+        """
+        Add friend to search index or update indexed data
+        :param friend: Friend instance
+        """
+        names = [friend.name, self._tox.friend_get_name(friend.number)]  # alias and name
+        self._search_index.add(friend.number, names, friend.status_message, friend.tox_id)
+
     def get_friend_by_number(self, num):
         return filter(lambda x: x.number == num, self._friends)[0]
 
@@ -390,38 +737,26 @@ class Profile(Contact, Singleton):
             self._screen.account_status.setText('')
             self._active_friend = -1
             self._screen.account_avatar.setHidden(True)
+            self._active_view.hide()
+            self.set_active_view(self._empty_view)
             self._messages.clear()
+            self._active_view.show()
             self._screen.messageEdit.clear()
             return
         try:
             self.send_typing(False)
             self._screen.typing.setVisible(False)
             if value is not None:
+                self.save_draft()
                 self._active_friend = value
                 friend = self._friends[value]
                 self._friends[value].set_messages(False)
-                self._screen.messageEdit.clear()
-                self._messages.clear()
-                friend.load_corr()
-                messages = friend.get_corr()[-PAGE_SIZE:]
-                for message in messages:
-                    if message.get_type() <= 1:
-                        data = message.get_data()
-                        self.create_message_item(data[0],
-                                                 convert_time(data[2]),
-                                                 friend.name if data[1] else self._name,
-                                                 data[3])
-                    elif message.get_type() == 2:
-                        item = self.create_file_transfer_item(message)
-                        if message.get_status() in (2, 4):  # active file transfer
-                            ft = self._file_transfers[(message.get_friend_number(), message.get_file_number())]
-                            ft.set_state_changed_handler(item.update)
-                    else:  # inline
-                        self.create_inline_item(message.get_data())
-                self._messages.scrollToBottom()
-                if value in self._call:
+                self.update_friend_position(friend)
+                self._screen.messageEdit.setPlainText(self._drafts.get(friend.tox_id, ''))
+                self.show_chat_view(friend)
+                if friend.number in self._call:
                     self._screen.active_call()
-                elif value in self._incoming_calls:
+                elif friend.number in self._incoming_calls:
                     self._screen.incoming_call()
                 else:
                     self._screen.call_finished()
@@ -430,13 +765,8 @@ class Profile(Contact, Singleton):
 
             self._screen.account_name.setText(friend.name)
             self._screen.account_status.setText(friend.status_message)
-            avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(friend.tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-            if not os.path.isfile(avatar_path):  # load default image
-                avatar_path = curr_directory() + '/images/avatar.png'
-            pixmap = QtGui.QPixmap(QtCore.QSize(64, 64))
-            pixmap.load(avatar_path)
             self._screen.account_avatar.setScaledContents(False)
-            self._screen.account_avatar.setPixmap(pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio))
+            self._screen.account_avatar.setPixmap(AvatarCache.get_pixmap(friend.tox_id))
             self._screen.account_avatar.repaint()  # comment?
         except:  # no friend found. ignore
             log('Incorrect friend value: ' + str(value))
@@ -444,27 +774,97 @@ class Profile(Contact, Singleton):
 
     active_friend = property(get_active, set_active)
 
+    def show_chat_view(self, friend):
+        """
+        Show messages of friend. Uses cached view if it exists, otherwise creates new view
+        :param friend: Friend instance
+        """
+        self._active_view.hide()
+        view = self._views.get(friend.number)
+        if view is None:
+            view = self.create_chat_view(friend)
+        self.set_active_view(view)
+        view.show()
+
+    def create_chat_view(self, friend):
+        """
+        Render last page of messages of friend in new hidden view and put it to cache
+        :param friend: Friend instance
+        :return: ChatView instance
+        """
+        view = ChatView(self._screen.create_messages_list())
+        self._views[friend.number] = view
+        messages, self._messages = self._messages, view.messages  # factories add items to self._messages
+        try:
+            friend.load_corr()
+            self.restore_pending_statuses(friend)
+            for message in friend.get_corr_page(0, PAGE_SIZE):
+                self.create_corr_item(friend, message)
+            view.messages.scrollToBottom()
+        finally:
+            self._messages = messages
+        return view
+
+    def close_chat_views(self):
+        """
+        Close all rendered chats and show empty view
+        """
+        self.set_active(-1)
+        for view in self._views.values():
+            view.close()
+        self._views.clear()
+
+    def set_active_view(self, view):
+        self._active_view = view
+        self._messages = self._screen.messages = view.messages
+
+    def drop_chat_view(self, friend_number):
+        """
+        Remove cached view of friend. It will be rebuilt when friend will become active
+        :param friend_number: number of friend
+        """
+        view = self._views.pop(friend_number)
+        if view is not None:
+            view.close()
+            if view is self._active_view:
+                self.set_active_view(self._empty_view)
+
+    def restore_chat_bottom(self):
+        """
+        Render newest messages of active friend again if they were released from view
+        """
+        if self._active_view.newer:
+            friend = self._friends[self._active_friend]
+            self.drop_chat_view(friend.number)
+            self.show_chat_view(friend)
+
     def get_last_message(self):
         return self._friends[self._active_friend].get_last_message_text()
 
     def get_active_number(self):
-        return self._friends[self._active_friend].number if self._active_friend + 1 else -1
+        return self._friends[self._active_friend].number if self._active_friend >= 0 else -1
 
     def get_active_name(self):
-        return self._friends[self._active_friend].name if self._active_friend + 1 else ''
+        return self._friends[self._active_friend].name if self._active_friend >= 0 else ''
 
     def is_active_online(self):
-        return self._active_friend + 1 and self._friends[self._active_friend].status is not None
+        return self._active_friend >= 0 and self._friends[self._active_friend].status is not None
 
     # -----------------------------------------------------------------------------------------------------------------
     # Typing notifications
     # -----------------------------------------------------------------------------------------------------------------
 
     def send_typing(self, typing):
-        if Settings.get_instance()['typing_notifications']:
+        """
+        Update typing state of user. Notification is sent from tox iterate thread
+        :param typing: True on keystroke, False if user stopped typing
+        """
+        if self._active_friend >= 0:
             friend = self._friends[self._active_friend]
-            if friend.status is not None:
-                self._tox.self_set_typing(friend.number, typing)
+            if not typing:
+                TypingNotifications.get_instance().stop(friend.number)
+            elif friend.status is not None and Settings.get_instance()['typing_notifications']:
+                TypingNotifications.get_instance().keystroke(friend.number)
 
     def friend_typing(self, friend_number, typing):
         if friend_number == self.get_active_number():
@@ -474,65 +874,172 @@ class Profile(Contact, Singleton):
     # Private messages
     # -----------------------------------------------------------------------------------------------------------------
 
-    def split_and_send(self, number, message_type, message):
+    def split_and_send(self, number, message_type, message, on_sent=None, on_delivered=None):
         """
-        Message splitting
+        Message splitting. Parts of message are taken by outgoing queue lazily
         :param number: friend's number
         :param message_type: type of message
-        :param message: message text
-        """
-        while len(message) > TOX_MAX_MESSAGE_LENGTH:
-            size = TOX_MAX_MESSAGE_LENGTH * 4 / 5
-            last_part = message[size:TOX_MAX_MESSAGE_LENGTH]
-            if ' ' in last_part:
-                index = last_part.index(' ')
-            elif ',' in last_part:
-                index = last_part.index(',')
-            elif '.' in last_part:
-                index = last_part.index('.')
-            else:
-                index = TOX_MAX_MESSAGE_LENGTH - size
-            index += size + 1
-            self._tox.friend_send_message(number, message_type, message[:index])
-            message = message[index:]
-        self._tox.friend_send_message(number, message_type, message)
+        :param message: message text (utf-8)
+        :param on_sent: function called in tox iterate thread when all parts were sent
+        :param on_delivered: function called in tox iterate thread when friend received all parts
+        """
+        OutgoingQueue.get_instance().put(number, message_type, split_message(message), on_sent, on_delivered)
+
+    def new_messages(self, messages):
+        """
+        Current user gets batch of new messages. Chat is repainted and scrolled once per batch
+        :param messages: list of tuples (friend number, message type, message, render)
+        """
+        self._messages.setUpdatesEnabled(False)
+        try:
+            for friend_num, message_type, message, render in messages:
+                self.new_message(friend_num, message_type, message, False, render)
+        finally:
+            self._messages.setUpdatesEnabled(True)
+        if not self._active_view.newer:
+            self._messages.scrollToBottom()
 
-    def new_message(self, friend_num, message_type, message):
+    def new_message(self, friend_num, message_type, message, scroll=True, render=True):
         """
         Current user gets new message
         :param friend_num: friend_num of friend who sent message
         :param message_type: message type - plain text or action message (/me)
         :param message: text of message
+        :param scroll: scroll active chat to new message
+        :param render: False if message is muted by flood control. It's saved and rendered when user scrolls to it
         """
         if friend_num == self.get_active_number():  # add message to list
-            user_name = Profile.get_instance().get_active_name()
-            self.create_message_item(message.decode('utf-8'), curr_time(), user_name, message_type)
-            self._messages.scrollToBottom()
-            self._friends[self._active_friend].append_message(
+            friend = self._friends[self._active_friend]
+            friend.append_message(
                 TextMessage(message.decode('utf-8'), MESSAGE_OWNER['FRIEND'], time.time(), message_type))
+            if render and self._active_view.is_bottom_muted():  # flood is over, render newest messages again
+                self.restore_chat_bottom()
+                if scroll:
+                    self._messages.scrollToBottom()
+            elif self._active_view.newer or not render:  # newest part of chat isn't rendered
+                self._active_view.skip_newest(not render)
+            else:
+                user_name = Profile.get_instance().get_active_name()
+                self.create_message_item(message.decode('utf-8'), curr_time(), user_name, message_type)
+                if scroll:
+                    self._messages.scrollToBottom()
+            self.update_friend_position(friend)
         else:
             friend = self.get_friend_by_number(friend_num)
             friend.set_messages(True)
             friend.append_message(
                 TextMessage(message.decode('utf-8'), MESSAGE_OWNER['FRIEND'], time.time(), message_type))
+            self.update_friend_position(friend)
+            view = self._views.peek(friend_num)
+            if view is not None and render and view.is_bottom_muted():
+                self.drop_chat_view(friend_num)  # flood is over, view is rebuilt with newest messages when opened
+            elif view is not None and (view.newer or not render):
+                view.skip_newest(not render)
+            elif view is not None:  # update rendered chat in background
+                self.create_message_item(message.decode('utf-8'), curr_time(), friend.name, message_type,
+                                         messages=view.messages)
 
     def send_message(self, text):
         """
         Send message to active friend
         :param text: message text
         """
-        if self.is_active_online() and text:
+        if self._active_friend >= 0 and text:
             if text.startswith('/me '):
                 message_type = TOX_MESSAGE_TYPE['ACTION']
                 text = text[4:]
             else:
                 message_type = TOX_MESSAGE_TYPE['NORMAL']
             friend = self._friends[self._active_friend]
-            self.split_and_send(friend.number, message_type, text.encode('utf-8'))
-            self.create_message_item(text, curr_time(), self._name, message_type)
+            message = TextMessage(text, MESSAGE_OWNER['ME'], time.time(), message_type, MESSAGE_STATUS['PENDING'])
+            self.restore_chat_bottom()
+            item = self.create_message_item(text, curr_time(), self._name, message_type)
+            message.set_status_handler(item.set_status)
+            item.set_status(message.get_status())
             self._screen.messageEdit.clear()
             self._messages.scrollToBottom()
-            friend.append_message(TextMessage(text, MESSAGE_OWNER['ME'], time.time(), message_type))
+            self.send_typing(False)
+            friend.append_message(message)
+            self.update_friend_position(friend)
+            self.add_pending_message(friend, message)
+
+    def add_pending_message(self, friend, message):
+        """
+        Save message to db and send it if friend is online, else it will be sent when friend becomes online
+        :param friend: Friend instance
+        :param message: TextMessage instance
+        """
+        text, owner, unix_time, message_type = message.get_data()
+        pending_id = self._history.add_pending(friend.tox_id, text, message_type, unix_time)
+        self._pending_messages[pending_id] = message
+        if friend.status is not None:
+            self.queue_pending_message(friend.number, pending_id, text, message_type)
+
+    def send_pending_messages(self, friend_number):
+        """
+        Friend became online. Messages which friend didn't receive (including ones from previous sessions) are
+        queued again
+        :param friend_number: number of friend
+        """
+        if not hasattr(self, '_history'):  # profile was closed
+            return
+        friend = self.get_friend_by_number(friend_number)
+        OutgoingQueue.get_instance().remove(friend_number)
+        for key in filter(lambda x: x[0] == friend_number and type(self._file_transfers[x]) is SendText,
+                          self._file_transfers.keys()):  # transfers were stopped by toxcore on disconnect
+            del self._file_transfers[key]
+        for pending_id, text, message_type, unix_time in self._history.get_pending(friend.tox_id):
+            self.queue_pending_message(friend_number, pending_id, text, message_type)
+
+    def restore_pending_statuses(self, friend):
+        """
+        Messages from history which friend didn't receive in previous sessions are shown as pending and get
+        status updates when they are sent again
+        :param friend: Friend instance which history was loaded
+        """
+        pending = dict(((text, unix_time), pending_id)
+                       for pending_id, text, message_type, unix_time in self._history.get_pending(friend.tox_id))
+        if not pending:
+            return
+        for message in friend.get_corr():
+            if message.get_type() > 1 or message.get_owner() != MESSAGE_OWNER['ME']:
+                continue
+            text, owner, unix_time, message_type = message.get_data()
+            pending_id = pending.get((text, unix_time))
+            if pending_id is not None and pending_id not in self._pending_messages:
+                message.set_status(MESSAGE_STATUS['PENDING'])
+                self._pending_messages[pending_id] = message
+
+    def queue_pending_message(self, friend_number, pending_id, text, message_type, as_file=True):
+        """
+        Add message to outgoing queue. It's removed from db when friend's read receipts for all parts are received.
+        Long texts are sent as files and removed from db when transfer is finished
+        :param friend_number: number of friend
+        :param pending_id: id of pending message in db
+        :param text: message text
+        :param message_type: type of message
+        :param as_file: allow to send long text as file
+        """
+        if as_file and len(text) > MAX_TEXT_MESSAGE_SIZE and message_type == TOX_MESSAGE_TYPE['NORMAL']:
+            def started(future):
+                if future.exception() is not None:  # friend went offline, message will be sent on reconnect
+                    log('Text was not sent as file: ' + str(future.exception()))
+            SendText(self._tox, friend_number, text, pending_id).start(self._file_transfers).add_done_callback(started)
+            return
+        history, pending_messages = self._history, self._pending_messages
+
+        def sent():  # called in tox iterate thread
+            message = pending_messages.get(pending_id)
+            if message is not None:
+                message.set_status(MESSAGE_STATUS['SENT'])
+
+        def delivered():  # called in tox iterate thread
+            history.delete_pending(pending_id)
+            message = pending_messages.pop(pending_id, None)
+            if message is not None:
+                message.set_status(MESSAGE_STATUS['DELIVERED'])
+
+        self.split_and_send(friend_number, message_type, text.encode('utf-8'), sent, delivered)
 
     # -----------------------------------------------------------------------------------------------------------------
     # History support
@@ -555,40 +1062,53 @@ class Profile(Contact, Singleton):
         if num is not None:
             friend = self._friends[num]
             friend.clear_corr()
+            if num != self._active_friend:
+                self.drop_chat_view(friend.number)
             if self._history.friend_exists_in_db(friend.tox_id):
                 self._history.delete_messages(friend.tox_id)
                 self._history.delete_friend_from_db(friend.tox_id)
         else:  # clear all history
             for number in xrange(len(self._friends)):
                 self.clear_history(number)
-        if num is None or num == self.get_active_number():
-            self._messages.clear()
+        if num is None or num == self._active_friend:
+            self._active_view.clear()
             self._messages.repaint()
 
     def load_history(self):
         """
-        Tries to load next part of messages
+        Tries to load previous part of messages. Rows far below the viewport are released
         """
+        if self._active_friend == -1:
+            return
         friend = self._friends[self._active_friend]
-        friend.load_corr(False)
-        data = friend.get_corr()
-        if not data:
+        messages = friend.get_corr_page(self._active_view.get_offset(), PAGE_SIZE)
+        if not messages:
             return
-        data.reverse()
-        data = data[self._messages.count():self._messages.count() + PAGE_SIZE]
-        for message in data:
-            if message.get_type() <= 1:
-                data = message.get_data()
-                self.create_message_item(data[0],
-                                         convert_time(data[2]),
-                                         friend.name if data[1] else self._name,
-                                         data[3],
-                                         False)
-            elif message.get_type() == 2:
-                item = self.create_file_transfer_item(message, False)
-                if message.get_status() in (2, 4):
-                    ft = self._file_transfers[(message.get_friend_number(), message.get_file_number())]
-                    ft.set_state_changed_handler(item.update)
+        height = 0
+        for message in reversed(messages):
+            height += self.create_corr_item(friend, message, False)
+        self._active_view.release_newest()
+        self._messages.doItemsLayout()
+        scroll = self._messages.verticalScrollBar()
+        scroll.setValue(scroll.value() + height)
+
+    def load_newer_history(self):
+        """
+        Tries to render again next part of messages which were released from view. Rows far above the viewport are
+        released
+        """
+        if self._active_friend == -1 or not self._active_view.newer:
+            return
+        friend = self._friends[self._active_friend]
+        count = min(self._active_view.newer, PAGE_SIZE)
+        messages = friend.get_corr_page(self._active_view.newer - count, count)
+        self._active_view.newer -= count
+        for message in messages:
+            self.create_corr_item(friend, message)
+        height = self._active_view.release_oldest()
+        self._messages.doItemsLayout()
+        scroll = self._messages.verticalScrollBar()
+        scroll.setValue(scroll.value() - height)
 
     def export_history(self, directory):
         self._history.export(directory)
@@ -603,21 +1123,53 @@ class Profile(Contact, Singleton):
         :return: new widget for friend instance
         """
         item = ContactItem()
-        elem = QtGui.QListWidgetItem(self._screen.friends_list)
+        elem = ContactListItem()
+        elem.setData(ContactListItem.SORT_KEY_ROLE, ContactListItem.NEW_ROW_SORT_KEY)
         elem.setSizeHint(QtCore.QSize(250, 70))
         self._screen.friends_list.addItem(elem)
         self._screen.friends_list.setItemWidget(elem, item)
         return item
 
-    def create_message_item(self, text, time, name, message_type, append=True):
-        item = MessageItem(text, time, name, message_type, self._messages)
+    def create_corr_item(self, friend, message, append=True):
+        """
+        Method-factory. Creates item for message from friend's history
+        :param friend: Friend instance
+        :param message: Message instance
+        :param append: add item to the end of list or insert it before first item
+        :return: height of new item
+        """
+        if message.get_type() <= 1:
+            data = message.get_data()
+            item = self.create_message_item(data[0],
+                                            convert_time(data[2]),
+                                            friend.name if data[1] else self._name,
+                                            data[3],
+                                            append)
+            if message.get_status() != MESSAGE_STATUS['DELIVERED']:
+                message.set_status_handler(item.set_status)
+                item.set_status(message.get_status())
+        elif message.get_type() == 2:
+            item = self.create_file_transfer_item(message, append)
+            if message.get_status() in (2, 4):  # active file transfer
+                ft = self._file_transfers[(message.get_friend_number(), message.get_file_number())]
+                ft.set_state_changed_handler(item.update)
+        else:  # inline
+            self.create_inline_item(message.get_data(), append)
+        return self._messages.item(self._messages.count() - 1 if append else 0).sizeHint().height()
+
+    def create_message_item(self, text, time, name, message_type, append=True, messages=None):
+        if messages is None:
+            messages = self._messages
+        item = MessageItem(text, time, name, message_type, messages)
         elem = QtGui.QListWidgetItem()
-        elem.setSizeHint(QtCore.QSize(self._messages.width(), item.height()))
+        elem.setSizeHint(QtCore.QSize(messages.width(), item.height()))
         if append:
-            self._messages.addItem(elem)
+            messages.addItem(elem)
         else:
-            self._messages.insertItem(0, elem)
-        self._messages.setItemWidget(elem, item)
+            messages.insertItem(0, elem)
+        messages.setItemWidget(elem, item)
+        item.resized.connect(lambda: elem.setSizeHint(QtCore.QSize(messages.width(), item.height())))
+        return item
 
     def create_file_transfer_item(self, tm, append=True):
         data = list(tm.get_data())
@@ -680,6 +1232,7 @@ class Profile(Contact, Singleton):
                 except:
                     pass
             settings.save()
+            self.index_friend(friend)
             self.set_active()
 
     def friend_public_key(self, num):
@@ -694,27 +1247,55 @@ class Profile(Contact, Singleton):
         self.clear_history(num)
         if self._history.friend_exists_in_db(friend.tox_id):
             self._history.delete_friend_from_db(friend.tox_id)
-        self._tox.friend_delete(friend.number)
-        del self._friends[num]
+        ToxCommands.get_instance().call(self._tox.friend_delete, friend.number)
+        SentAvatars.get_instance().remove(friend.tox_id)
+        self.drop_chat_view(friend.number)
+        self._search_index.remove(friend.number)
+        OutgoingQueue.get_instance().remove(friend.number)
+        TypingNotifications.get_instance().remove(friend.number)
+        FloodControl.get_instance().remove(friend.number)
+        self._history.delete_pending_messages(friend.tox_id)
+        del self._friends[num], self._sort_keys[num]
+        self.update_rows()
         self._screen.friends_list.takeItem(num)
+        self._drafts.pop(friend.tox_id, None)
         if num == self._active_friend:  # active friend was deleted
+            self._active_friend = -1
             if not len(self._friends):  # last friend was deleted
                 self.set_active(-1)
             else:
                 self.set_active(0)
 
     def add_friend(self, tox_id):
-        num = self._tox.friend_add_norequest(tox_id)  # num - friend number
+        """
+        Add friend without request. Friend appears in list when toxcore adds them
+        :param tox_id: public key of friend
+        """
+        def added(future):
+            if future.exception() is not None:
+                log('Accept friend request failed! ' + str(future.exception()))
+                return
+            self.create_new_friend(future.result(), tox_id)
+        ToxCommands.get_instance().call(self._tox.friend_add_norequest, tox_id).add_done_callback(added)
+
+    def create_new_friend(self, number, public_key):
+        """
+        Add friend created by toxcore to friends list
+        :param number: friend's number
+        :param public_key: friend's public key
+        """
         item = self.create_friend_item()
         try:
-            if not self._history.friend_exists_in_db(tox_id):
-                self._history.add_friend_to_db(tox_id)
-            message_getter = self._history.messages_getter(tox_id)
+            if not self._history.friend_exists_in_db(public_key):
+                self._history.add_friend_to_db(public_key)
+            message_getter = self._history.messages_getter(public_key)
         except Exception as ex:  # something is wrong
-            log('Accept friend request failed! ' + str(ex))
+            log('Adding friend to db failed! ' + str(ex))
             message_getter = None
-        friend = Friend(message_getter, num, tox_id, '', item, tox_id)
-        self._friends.append(friend)
+        friend = Friend(message_getter, number, public_key, '', item, public_key)
+        self.append_friend(friend)
+        self.index_friend(friend)
+        self.update_friend_position(friend)
 
     def block_user(self, tox_id):
         tox_id = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
@@ -741,31 +1322,120 @@ class Profile(Contact, Singleton):
     # Friend requests
     # -----------------------------------------------------------------------------------------------------------------
 
-    def send_friend_request(self, tox_id, message):
+    def send_friend_request(self, tox_id, message, callback):
         """
         Function tries to send request to contact with specified id
         :param tox_id: id of new contact or tox dns 4 value
         :param message: additional message
-        :return: True on success else error string
+        :param callback: function which gets True on success else error string. Called in main thread
         """
+        def sent(future):
+            if future.exception() is not None:  # wrong data
+                log('Friend request failed with ' + str(future.exception()))
+                callback(str(future.exception()))
+            else:
+                self.create_new_friend(future.result(), tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
+                callback(True)
         try:
             message = message or 'Add me to your contact list'
             if '@' in tox_id:  # value like groupbot@toxme.io
                 tox_id = tox_dns(tox_id)
                 if tox_id is None:
                     raise Exception('TOX DNS lookup failed')
-            result = self._tox.friend_add(tox_id, message.encode('utf-8'))
-            tox_id = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
-            item = self.create_friend_item()
-            if not self._history.friend_exists_in_db(tox_id):
-                self._history.add_friend_to_db(tox_id)
-            message_getter = self._history.messages_getter(tox_id)
-            friend = Friend(message_getter, result, tox_id, '', item, tox_id)
-            self._friends.append(friend)
-            return True
-        except Exception as ex:  # wrong data
+            error = self.check_friend_request(tox_id, set(friend.tox_id for friend in self._friends))
+            if error is not None:
+                raise Exception(error)
+        except Exception as ex:
             log('Friend request failed with ' + str(ex))
-            return str(ex)
+            callback(str(ex))
+            return
+        future = ToxCommands.get_instance().call(self._tox.friend_add, tox_id, message.encode('utf-8'))
+        future.add_done_callback(sent)
+
+    def send_friend_requests(self, tox_ids, message, callback):
+        """
+        Send friend requests to many contacts in one command. History is updated in one transaction
+        :param tox_ids: list of tox ids
+        :param message: message of requests
+        :param callback: function which gets list of errors, None for successful requests. Called in main thread
+        """
+        tox, message = self._tox, message.encode('utf-8')
+        friends = set(friend.tox_id for friend in self._friends)
+        errors = [self.check_friend_request(tox_id, friends) for tox_id in tox_ids]
+        checked = [tox_id for tox_id, error in zip(tox_ids, errors) if error is None]
+        if not checked:
+            callback(errors)
+            return
+
+        def send():  # called in tox iterate thread
+            results = []
+            for tox_id in checked:
+                try:
+                    results.append((tox.friend_add(tox_id, message), None))
+                except Exception as ex:
+                    results.append((None, str(ex)))
+            return results
+
+        def sent(future):
+            if future.exception() is not None:
+                results = [(None, str(future.exception()))] * len(checked)
+            else:
+                results = future.result()
+            added = [(number, tox_id[:TOX_PUBLIC_KEY_SIZE * 2]) for tox_id, (number, error) in zip(checked, results)
+                     if error is None]
+            self.add_new_friends(added)
+            results = iter(results)
+            callback([error if error is not None else next(results)[1] for error in errors])
+        ToxCommands.get_instance().call(send).add_done_callback(sent)
+
+    def check_friend_request(self, tox_id, friends):
+        """
+        :param tox_id: tox id of contact
+        :param friends: set of public keys of friends
+        :return: error string if request can't be sent to contact else None
+        """
+        public_key = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
+        if public_key in Settings.get_instance()['blocked']:
+            return 'Contact is blocked'
+        if public_key in friends:
+            return 'Contact is already in friends list'
+        return None
+
+    def add_new_friends(self, added):
+        """
+        :param added: list of tuples (friend number, public key) of friends added by toxcore
+        """
+        self._history.add_friends_to_db([public_key for number, public_key in added])
+        for number, public_key in added:
+            item = self.create_friend_item()
+            friend = Friend(self._history.messages_getter(public_key), number, public_key, '', item, public_key)
+            self.append_friend(friend)
+            self.index_friend(friend)
+            self.update_friend_position(friend)
+        self.update_filtration()
+
+    def import_friends(self, path, message, callback):
+        """
+        Send friend requests to all contacts from file in background
+        :param path: path to file with tox ids and toxme addresses
+        :param message: message of requests
+        :param callback: function which gets report - list of tuples (line, error)
+        If other import is in progress, this one is started when it's finished
+        """
+        def finished(report):
+            friends_import.wait()  # thread emits last result right before it finishes
+            if self._friends_import is not friends_import:  # profile was closed
+                return
+            self._friends_import = None
+            callback(report)
+            if self._imports:
+                self.import_friends(*self._imports.pop(0))
+        if self._friends_import is not None:
+            self._imports.append((path, message, callback))
+            return
+        self._friends_import = friends_import = FriendsImport(path, message or 'Add me to your contact list',
+                                                              self.send_friend_requests, finished)
+        friends_import.start()
 
     def process_friend_request(self, tox_id, message):
         """
@@ -802,8 +1472,27 @@ class Profile(Contact, Singleton):
             friend.status = None
 
     def close(self):
+        self.cancel_background_tasks()
+        self.save_session()
+        self.save_contacts_snapshot()
         self._call.stop()
         del self._call
+        AvatarStore.get_instance().close()
+        SentAvatars.get_instance().save()
+
+    def cancel_background_tasks(self):
+        """
+        Stop import of friends and avatar optimization. Their callbacks are not called after profile is closed
+        """
+        self._imports = []
+        if self._friends_import is not None:
+            self._friends_import.cancel()
+            self._friends_import.wait()
+            self._friends_import = None
+        if self._avatar_optimizer is not None:
+            self._avatar_optimizer.cancel()
+            self._avatar_optimizer.wait()
+            self._avatar_optimizer = None
 
     # -----------------------------------------------------------------------------------------------------------------
     # File transfers support
@@ -817,6 +1506,12 @@ class Profile(Contact, Singleton):
         :param size: file size in bytes
         :param file_name: file name without path
         """
+        if file_name == TEXT_FILE_NAME and size <= MAX_TEXT_FILE_SIZE:  # long text message
+            self._file_transfers[(friend_number, file_number)] = ReceiveText(self._tox, friend_number, size,
+                                                                             file_number)
+            ToxCommands.get_instance().call(self._tox.file_control, friend_number, file_number,
+                                            TOX_FILE_CONTROL['RESUME'])
+            return
         settings = Settings.get_instance()
         friend = self.get_friend_by_number(friend_number)
         auto = settings['allow_auto_accept'] and friend.tox_id in settings['auto_accept_from_friends']
@@ -859,13 +1554,16 @@ class Profile(Contact, Singleton):
                                  file_name,
                                  friend_number,
                                  file_number)
-        if friend_number == self.get_active_number():
+        if friend_number == self.get_active_number() and self._active_view.newer:
+            self._active_view.skip_newest(False)
+        elif friend_number == self.get_active_number():
             item = self.create_file_transfer_item(tm)
             if (inline and size < 1024 * 1024) or auto:
                 self._file_transfers[(friend_number, file_number)].set_state_changed_handler(item.update)
             self._messages.scrollToBottom()
         else:
             friend.set_messages(True)
+            self.drop_chat_view(friend_number)
 
         friend.append_message(tm)
 
@@ -882,9 +1580,19 @@ class Profile(Contact, Singleton):
                 tr.cancel()
             else:
                 tr.cancelled()
+                if type(tr) is SendAvatar:
+                    if not tr.is_requested():  # friend probably has this avatar
+                        SentAvatars.get_instance().set_sent(self.get_friend_by_number(friend_number).tox_id,
+                                                            tr.get_hash(), False)
+                elif type(tr) is SendText:  # friend's client doesn't accept texts as files
+                    self.queue_pending_message(friend_number, tr.get_pending_id(), tr.get_text(),
+                                               TOX_MESSAGE_TYPE['NORMAL'], False)
             del self._file_transfers[(friend_number, file_number)]
+            if type(tr) in (SendText, ReceiveText):  # there is no file transfer item
+                return
         else:
-            self._tox.file_control(friend_number, file_number, TOX_FILE_CONTROL['CANCEL'])
+            ToxCommands.get_instance().call(self._tox.file_control, friend_number, file_number,
+                                            TOX_FILE_CONTROL['CANCEL'])
         self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                       FILE_TRANSFER_MESSAGE_STATUS['CANCELLED'])
 
@@ -902,7 +1610,8 @@ class Profile(Contact, Singleton):
         else:
             rt = ReceiveToBuffer(self._tox, friend_number, size, file_number)
         self._file_transfers[(friend_number, file_number)] = rt
-        self._tox.file_control(friend_number, file_number, TOX_FILE_CONTROL['RESUME'])
+        ToxCommands.get_instance().call(self._tox.file_control, friend_number, file_number,
+                                        TOX_FILE_CONTROL['RESUME'])
         if item is not None:
             rt.set_state_changed_handler(item.update)
         self.get_friend_by_number(friend_number).update_transfer_data(file_number,
@@ -915,18 +1624,8 @@ class Profile(Contact, Singleton):
         """
         friend = self._friends[self._active_friend]
         st = SendFromBuffer(self._tox, friend.number, data, 'toxygen_inline.png')
-        self._file_transfers[(friend.number, st.get_file_number())] = st
-        tm = TransferMessage(MESSAGE_OWNER['ME'],
-                             time.time(),
-                             FILE_TRANSFER_MESSAGE_STATUS['OUTGOING'],
-                             len(data),
-                             'toxygen_inline.png',
-                             friend.number,
-                             st.get_file_number())
-        item = self.create_file_transfer_item(tm)
-        friend.append_message(tm)
-        st.set_state_changed_handler(item.update)
-        self._messages.scrollToBottom()
+        st.start(self._file_transfers).add_done_callback(
+            lambda future: self.outgoing_transfer_started(future, st, len(data), 'toxygen_inline.png'))
 
     def send_file(self, path):
         """
@@ -935,18 +1634,36 @@ class Profile(Contact, Singleton):
         """
         friend_number = self.get_active_number()
         st = SendTransfer(path, self._tox, friend_number)
-        self._file_transfers[(friend_number, st.get_file_number())] = st
+        st.start(self._file_transfers).add_done_callback(
+            lambda future: self.outgoing_transfer_started(future, st, os.path.getsize(path), os.path.basename(path)))
+
+    def outgoing_transfer_started(self, future, transfer, size, file_name):
+        """
+        Toxcore started sending file, transfer is shown in chat
+        :param future: ToxFuture of file_send call
+        :param transfer: SendTransfer or SendFromBuffer instance
+        :param size: file size in bytes
+        :param file_name: file name without path
+        """
+        if future.exception() is not None:
+            log('File was not sent: ' + str(future.exception()))
+            return
+        friend_number = transfer.get_friend_number()
         tm = TransferMessage(MESSAGE_OWNER['ME'],
                              time.time(),
                              FILE_TRANSFER_MESSAGE_STATUS['OUTGOING'],
-                             os.path.getsize(path),
-                             os.path.basename(path),
+                             size,
+                             file_name,
                              friend_number,
-                             st.get_file_number())
-        item = self.create_file_transfer_item(tm)
-        st.set_state_changed_handler(item.update)
-        self._friends[self._active_friend].append_message(tm)
-        self._messages.scrollToBottom()
+                             transfer.get_file_number())
+        self.get_friend_by_number(friend_number).append_message(tm)
+        if friend_number == self.get_active_number():
+            self.restore_chat_bottom()
+            item = self.create_file_transfer_item(tm)
+            transfer.set_state_changed_handler(item.update)
+            self._messages.scrollToBottom()
+        else:  # user opened other chat, item is created when view is rebuilt
+            self.drop_chat_view(friend_number)
 
     def incoming_chunk(self, friend_number, file_number, position, data):
         if (friend_number, file_number) in self._file_transfers:
@@ -954,8 +1671,16 @@ class Profile(Contact, Singleton):
             transfer.write_chunk(position, data)
             if transfer.state:
                 if type(transfer) is ReceiveAvatar:
-                    self.get_friend_by_number(friend_number).load_avatar()
+                    friend = self.get_friend_by_number(friend_number)
+                    AvatarCache.invalidate(friend.tox_id)
+                    friend.load_avatar()
                     self.set_active(None)
+                elif type(transfer) is ReceiveText:
+                    text = transfer.get_text()
+                    if text:
+                        self.new_message(friend_number, TOX_MESSAGE_TYPE['NORMAL'], text)
+                    else:
+                        log('Invalid text file from friend #{}'.format(friend_number))
                 elif type(transfer) is ReceiveToBuffer:
                     inline = InlineImage(transfer.get_data())
                     i = self.get_friend_by_number(friend_number).update_transfer_data(file_number,
@@ -963,11 +1688,17 @@ class Profile(Contact, Singleton):
                                                                                       inline)
                     if friend_number == self.get_active_number():
                         count = self._messages.count()
-                        item = InlineImageItem(transfer.get_data())
-                        elem = QtGui.QListWidgetItem()
-                        elem.setSizeHint(QtCore.QSize(600, item.height()))
-                        self._messages.insertItem(count + i + 1, elem)
-                        self._messages.setItemWidget(elem, item)
+                        position = count + self._active_view.newer + i + 1
+                        if position > count:  # inline is in released part of view
+                            self._active_view.skip_newest(False)
+                        elif position >= 0:
+                            item = InlineImageItem(transfer.get_data())
+                            elem = QtGui.QListWidgetItem()
+                            elem.setSizeHint(QtCore.QSize(600, item.height()))
+                            self._messages.insertItem(position, elem)
+                            self._messages.setItemWidget(elem, item)
+                    else:
+                        self.drop_chat_view(friend_number)
                 else:
                     self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                                   FILE_TRANSFER_MESSAGE_STATUS['FINISHED'])
@@ -979,13 +1710,25 @@ class Profile(Contact, Singleton):
             transfer.send_chunk(position, size)
             if transfer.state:
                 del self._file_transfers[(friend_number, file_number)]
-                if type(transfer) is not SendAvatar:
+                if type(transfer) is SendAvatar:
+                    if transfer.state == TOX_FILE_TRANSFER_STATE['FINISHED']:
+                        SentAvatars.get_instance().set_sent(self.get_friend_by_number(friend_number).tox_id,
+                                                            transfer.get_hash())
+                elif type(transfer) is SendText:
+                    if transfer.state == TOX_FILE_TRANSFER_STATE['FINISHED']:
+                        self._history.delete_pending(transfer.get_pending_id())
+                        message = self._pending_messages.pop(transfer.get_pending_id(), None)
+                        if message is not None:
+                            message.set_status(MESSAGE_STATUS['DELIVERED'])
+                else:
                     if type(transfer) is SendFromBuffer and Settings.get_instance()['allow_inline']:  # inline
                         inline = InlineImage(transfer.get_data())
                         self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                                       FILE_TRANSFER_MESSAGE_STATUS['FINISHED'],
                                                                                       inline)
-                        self.set_active(self._active_friend)
+                        self.drop_chat_view(friend_number)
+                        if friend_number == self.get_active_number():
+                            self.set_active(self._active_friend)
                     else:
                         self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                                       FILE_TRANSFER_MESSAGE_STATUS['FINISHED'])
@@ -998,11 +1741,24 @@ class Profile(Contact, Singleton):
         """
         :param friend_number: number of friend who should get new avatar
         """
-        avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-        if not os.path.isfile(avatar_path):  # reset image
-            avatar_path = None
-        sa = SendAvatar(avatar_path, self._tox, friend_number)
-        self._file_transfers[(friend_number, sa.get_file_number())] = sa
+        data, avatar_hash = self.get_avatar_data()
+        if SentAvatars.get_instance().is_sent(self.get_friend_by_number(friend_number).tox_id, avatar_hash):
+            return
+        SendAvatar(self._tox, friend_number, data, avatar_hash).start(self._file_transfers)
+
+    def get_avatar_data(self):
+        """
+        Avatar is read from storage once, data is shared by transfers to all friends
+        :return: tuple (avatar data, hash), data is empty string and hash is None if there is no avatar
+        """
+        if self._avatar_data is None:
+            store = AvatarStore.get_instance()
+            public_key = self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
+            if public_key in store:
+                self._avatar_data = (store.get(public_key), store.get_hash(public_key))
+            else:  # reset image
+                self._avatar_data = ('', None)
+        return self._avatar_data
 
     def incoming_avatar(self, friend_number, file_number, size):
         """
@@ -1015,17 +1771,37 @@ class Profile(Contact, Singleton):
         if ra.state != TOX_FILE_TRANSFER_STATE['CANCELED']:
             self._file_transfers[(friend_number, file_number)] = ra
         else:
-            self.get_friend_by_number(friend_number).load_avatar()
+            friend = self.get_friend_by_number(friend_number)
+            AvatarCache.invalidate(friend.tox_id)
+            friend.load_avatar()
             if self.get_active_number() == friend_number:
                 self.set_active(None)
 
     def reset_avatar(self):
         super(Profile, self).reset_avatar()
+        self._avatar_data = ('', None)
         for friend in filter(lambda x: x.status is not None, self._friends):
             self.send_avatar(friend.number)
 
+    def set_avatar_from_file(self, path):
+        """
+        Optimize image in background and use it as new avatar
+        :param path: path to image
+        """
+        def set_avatar(data):
+            if data is not None:
+                self.set_avatar(data)
+            else:
+                log('Invalid avatar: ' + path)
+        if self._avatar_optimizer is not None and self._avatar_optimizer.isRunning():  # newer image is used
+            self._avatar_optimizer.cancel()
+            self._avatar_optimizer.wait()
+        self._avatar_optimizer = AvatarOptimizer(path, set_avatar)
+        self._avatar_optimizer.start()
+
     def set_avatar(self, data):
         super(Profile, self).set_avatar(data)
+        self._avatar_data = None
         for friend in filter(lambda x: x.status is not None, self._friends):
             self.send_avatar(friend.number)
 
@@ -1062,7 +1838,7 @@ class Profile(Contact, Singleton):
         else:
             text = QtGui.QApplication.translate("incoming_call", "Incoming audio call", None, QtGui.QApplication.UnicodeUTF8)
         self._call_widget = avwidgets.IncomingCallWidget(friend_number, text, friend.name)
-        self._call_widget.set_pixmap(friend.get_pixmap())
+        self._call_widget.set_pixmap(AvatarCache.get_pixmap(friend.tox_id))
         self._call_widget.show()
 
     def accept_call(self, friend_number, audio, video):
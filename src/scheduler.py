@@ -0,0 +1,96 @@
+from PySide import QtCore
+from bisect import bisect_left
+from tox_commands import ToxCommands
+from outgoing_queue import OutgoingQueue
+from typing_notifications import TypingNotifications
+from util import wait_scheduler_wakeup
+import time
+
+
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)  # upper bounds of histogram buckets in ms
+
+
+class Histogram(object):
+    """
+    Histogram of durations with fixed buckets. Last bucket contains values bigger than last bound
+    """
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._count, self._sum, self._max = 0, 0., 0.
+
+    def add(self, value):
+        """
+        :param value: duration in ms
+        """
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    def get_data(self):
+        """
+        :return: dict with count of values, mean, max and list of tuples (upper bound or None, count) - buckets
+        """
+        return {'count': self._count,
+                'mean': self._sum / self._count if self._count else 0.,
+                'max': self._max,
+                'buckets': zip(self._bounds + (None, ), self._counts)}
+
+
+class ToxScheduler(QtCore.QThread):
+    """
+    Drives iterations of tox and toxav in one thread. Each loop sleeps until nearest deadline. ToxAV is iterated only
+    while there are active calls (call requests are received by tox iterate). Queued toxcore calls and outgoing
+    messages are processed as soon as they appear.
+    Latency of iterate calls and jitter (delay of iteration after its deadline) are recorded in histograms
+    """
+
+    def __init__(self, tox, calls):
+        """
+        :param tox: Tox instance
+        :param calls: calls.AV instance of current profile. Scheduler keeps it, so profile can be closed while
+        scheduler is running
+        """
+        QtCore.QThread.__init__(self)
+        self.tox, self.toxav = tox, tox.AV
+        self._calls = calls
+        self.stop = False
+        self._stats = {'tox_latency': Histogram(), 'tox_jitter': Histogram(),
+                       'av_latency': Histogram(), 'av_jitter': Histogram()}
+
+    def run(self):
+        next_tox, next_av = time.time(), None  # next_av is None while there are no calls
+        while not self.stop:
+            now = time.time()
+            if now >= next_tox:
+                self._stats['tox_jitter'].add((now - next_tox) * 1000)
+                self.tox.iterate()
+                self._stats['tox_latency'].add((time.time() - now) * 1000)
+                next_tox = now + self.tox.iteration_interval() / 1000.
+            ToxCommands.get_instance().execute()
+            OutgoingQueue.get_instance().drain(self.tox)
+            TypingNotifications.get_instance().update(self.tox)
+            deadline = next_tox
+            if self._calls.has_calls():
+                now = time.time()
+                if next_av is None:  # call was started, av iteration begins now
+                    next_av = now
+                if now >= next_av:
+                    self._stats['av_jitter'].add((now - next_av) * 1000)
+                    self.toxav.iterate()
+                    self._stats['av_latency'].add((time.time() - now) * 1000)
+                    next_av = now + self.toxav.iteration_interval() / 1000.
+                deadline = min(deadline, next_av)
+            else:
+                next_av = None
+            timeout = deadline - time.time()
+            if timeout > 0:
+                wait_scheduler_wakeup(timeout)
+
+    def get_stats(self):
+        """
+        :return: dict. Key - name of histogram, value - data of histogram
+        """
+        return dict((name, histogram.get_data()) for name, histogram in self._stats.items())
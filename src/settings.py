@@ -9,8 +9,9 @@ import pyaudio
 class Settings(Singleton, dict):
 
     def __init__(self, name):
-        self.path = ProfileHelper.get_path() + str(name) + '.json'
+        self.path = ProfileStorage.get_instance().get_settings_path()
         self.name = name
+        self.clear()  # settings of previous profile
         if os.path.isfile(self.path):
             with open(self.path) as fl:
                 data = fl.read()
@@ -19,6 +20,8 @@ class Settings(Singleton, dict):
         else:
             super(self.__class__, self).__init__(Settings.get_default_settings())
             self.save()
+        if hasattr(self, 'audio'):  # profile was switched, audio devices are already known
+            return
         p = pyaudio.PyAudio()
         self.audio = {'input': p.get_default_input_device_info()['index'],
                       'output': p.get_default_output_device_info()['index']}
@@ -64,6 +67,14 @@ class Settings(Singleton, dict):
             'friends_aliases': [],
             'typing_notifications': False,
             'calls_sound': True,
+            'avatar_resolution': 128,
+            'sort_friends_by_activity': False,
+            'active_friend': None,
+            'active_chat_scroll': 0,
+            'drafts': {},
+            'unread_friends': [],
+            'flood_throttle_rate': 5,
+            'flood_mute_rate': 100,
             'blocked': []
         }
 
@@ -172,7 +183,8 @@ class ProfileHelper(object):
         path = path.decode(locale.getpreferredencoding())
         ProfileHelper._path = path + name + '.tox'
         ProfileHelper._directory = path
-        with open(ProfileHelper._path, 'rb') as fl:
+        ProfileStorage(path, name)
+        with open(ProfileStorage.get_instance().get_savedata_path(), 'rb') as fl:
             data = fl.read()
         if data:
             return data
@@ -184,7 +196,8 @@ class ProfileHelper(object):
         if name is not None:
             ProfileHelper._path = Settings.get_default_path() + name + '.tox'
             ProfileHelper._directory = Settings.get_default_path()
-        with open(ProfileHelper._path, 'wb') as fl:
+            ProfileStorage(Settings.get_default_path(), name)
+        with open(ProfileStorage.get_instance().get_savedata_path(), 'wb') as fl:
             fl.write(data)
 
     @staticmethod
@@ -199,3 +212,39 @@ class ProfileHelper(object):
     @staticmethod
     def get_path():
         return ProfileHelper._directory
+
+
+class ProfileStorage(Singleton):
+    """
+    Absolute paths of files of current profile: savedata, settings, history, avatars.
+    Working directory of process is shared by all threads, so profile files are never opened by relative paths
+    """
+
+    def __init__(self, directory, name):
+        """
+        :param directory: directory with profile
+        :param name: name of profile
+        """
+        self._directory = os.path.join(os.path.abspath(directory), '')
+        self._name = name
+
+    def get_directory(self):
+        return self._directory
+
+    def get_savedata_path(self):
+        return self._directory + self._name + '.tox'
+
+    def get_settings_path(self):
+        return self._directory + self._name + '.json'
+
+    def get_contacts_snapshot_path(self):
+        return self._directory + self._name + '.contacts'
+
+    def get_history_path(self, public_key):
+        """
+        :param public_key: public key of profile
+        """
+        return self._directory + public_key + '.hstr'
+
+    def get_avatars_directory(self):
+        return self._directory + 'avatars/'
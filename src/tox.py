@@ -947,9 +947,9 @@ class Tox(object):
         elif tox_err_friend_send_message == TOX_ERR_FRIEND_SEND_MESSAGE['FRIEND_NOT_FOUND']:
             raise ArgumentError('The friend number did not designate a valid friend.')
         elif tox_err_friend_send_message == TOX_ERR_FRIEND_SEND_MESSAGE['FRIEND_NOT_CONNECTED']:
-            raise ArgumentError('This client is currently not connected to the friend.')
+            raise RuntimeError('This client is currently not connected to the friend.')
         elif tox_err_friend_send_message == TOX_ERR_FRIEND_SEND_MESSAGE['SENDQ']:
-            raise ArgumentError('An allocation error occurred while increasing the send queue size.')
+            raise RuntimeError('An allocation error occurred while increasing the send queue size.')
         elif tox_err_friend_send_message == TOX_ERR_FRIEND_SEND_MESSAGE['TOO_LONG']:
             raise ArgumentError('Message length exceeded TOX_MAX_MESSAGE_LENGTH.')
         elif tox_err_friend_send_message == TOX_ERR_FRIEND_SEND_MESSAGE['EMPTY']:
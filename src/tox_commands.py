@@ -0,0 +1,99 @@
+from PySide import QtCore
+from collections import deque
+from util import log, Singleton, wake_scheduler
+import threading
+
+
+class ToxFuture(object):
+    """
+    Result of toxcore call executed in tox iterate thread
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result, self._exception = None, None
+        self._callbacks = []
+
+    def set_result(self, result, exception=None):
+        self._result, self._exception = result, exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for result. Must not be called in main thread
+        :return: result of call. Exception of call is raised
+        """
+        self._done.wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        :param callback: function which gets this future, called in main thread when call is executed
+        """
+        self._callbacks.append(callback)
+
+    def run_callbacks(self):
+        if self._exception is not None and not self._callbacks:
+            log('Tox call failed: ' + str(self._exception))
+        for callback in self._callbacks:
+            callback(self)
+
+
+class CallbacksInvoker(QtCore.QObject):
+    """
+    Lives in main thread, runs callbacks of executed calls
+    """
+    executed = QtCore.Signal(object)
+
+    def __init__(self):
+        super(CallbacksInvoker, self).__init__()
+        self.executed.connect(self.run_callbacks)
+
+    @QtCore.Slot(object)
+    def run_callbacks(self, future):
+        future.run_callbacks()
+
+
+class ToxCommands(Singleton):
+    """
+    Queue of calls to toxcore. Main thread never calls toxcore methods which change state directly: calls are
+    executed in tox iterate thread between iterations, in order they were added. Must be created in main thread
+    """
+
+    def __init__(self):
+        self._commands = deque()  # tuples (function, args, future), appends and pops of deque are atomic
+        self._invoker = CallbacksInvoker()
+
+    def call(self, fn, *args):
+        """
+        Add call to queue
+        :param fn: method of Tox instance or function which calls it
+        :return: ToxFuture instance
+        """
+        future = ToxFuture()
+        self._commands.append((fn, args, future))
+        wake_scheduler()
+        return future
+
+    def is_empty(self):
+        return not self._commands
+
+    def execute(self):
+        """
+        Execute all queued calls. Called in tox iterate thread or in main thread when iterate thread is stopped
+        """
+        while self._commands:
+            fn, args, future = self._commands.popleft()
+            try:
+                future.set_result(fn(*args))
+            except Exception as ex:
+                future.set_result(None, ex)
+            self._invoker.executed.emit(future)
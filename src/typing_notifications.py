@@ -0,0 +1,66 @@
+from util import log, Singleton
+import threading
+import time
+
+
+TYPING_TIMEOUT = 5.  # seconds without keystrokes after which user stops typing
+
+MIN_TYPING_INTERVAL = 1.  # min time in seconds between typing notifications sent to one friend
+
+
+class TypingNotifications(Singleton):
+    """
+    Typing state machine. Keystrokes only update time of last keystroke in main thread. Notifications are sent
+    from tox iterate thread on transitions between 'typing' and 'not typing' states, but not more often than
+    once per MIN_TYPING_INTERVAL for each friend
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keystrokes = {}  # key - friend number, value - unix time of last keystroke or 0 if user stopped typing
+        self._sent = {}  # key - friend number, value - tuple (state sent to friend, unix time when it was sent)
+
+    def keystroke(self, friend_number):
+        with self._lock:
+            self._keystrokes[friend_number] = time.time()
+
+    def stop(self, friend_number):
+        """
+        User sent message or switched to other friend
+        """
+        with self._lock:
+            if friend_number in self._keystrokes:
+                self._keystrokes[friend_number] = 0
+
+    def remove(self, friend_number):
+        """
+        Friend went offline, 'not typing' state shouldn't be sent
+        """
+        with self._lock:
+            self._keystrokes.pop(friend_number, None)
+            self._sent.pop(friend_number, None)
+
+    def update(self, tox):
+        """
+        Send changed states. Called in tox iterate thread after each iteration
+        :param tox: Tox instance
+        """
+        now = time.time()
+        with self._lock:
+            keystrokes = self._keystrokes.items()
+        for friend_number, last_keystroke in keystrokes:
+            typing = now - last_keystroke < TYPING_TIMEOUT
+            state, sent_time = self._sent.get(friend_number, (False, 0))
+            if typing == state:
+                if not typing:  # nothing to send until next keystroke
+                    with self._lock:
+                        if self._keystrokes.get(friend_number) == last_keystroke:
+                            del self._keystrokes[friend_number]
+                continue
+            if now - sent_time < MIN_TYPING_INTERVAL:
+                continue
+            try:
+                tox.self_set_typing(friend_number, typing)
+            except Exception as ex:
+                log('Typing notification was not sent: ' + str(ex))
+            self._sent[friend_number] = (typing, now)
@@ -1,16 +1,36 @@
 import os
 import time
+import threading
 from platform import system
+from collections import OrderedDict
 
 
 program_version = '0.1'
 
+_scheduler_wakeup = threading.Event()  # set when tox thread should run before its next iteration
+
 
 def log(data):
     with open(curr_directory() + '/logs.log', 'a') as fl:
         fl.write(str(data) + '\n')
 
 
+def wake_scheduler():
+    """
+    Wake tox scheduler, for example when calls to toxcore are queued
+    """
+    _scheduler_wakeup.set()
+
+
+def wait_scheduler_wakeup(timeout):
+    """
+    Sleep until timeout or until scheduler is woken. Called in tox thread
+    :param timeout: time in seconds
+    """
+    _scheduler_wakeup.wait(timeout)
+    _scheduler_wakeup.clear()
+
+
 def curr_directory():
     return os.path.dirname(os.path.realpath(__file__))
 
@@ -47,3 +67,62 @@ class Singleton(object):
     @classmethod
     def get_instance(cls):
         return cls._instance
+
+
+class LRUCache(object):
+    """
+    Dict-like container which keeps only last used items
+    """
+
+    def __init__(self, size, on_remove=None):
+        """
+        :param size: max count of items in cache
+        :param on_remove: function (key, value) which is called when item is pushed out of cache
+        """
+        self._size = size
+        self._on_remove = on_remove
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        self._data[key] = value
+        while len(self._data) > self._size:
+            old_key, old_value = self._data.popitem(last=False)
+            if self._on_remove is not None:
+                self._on_remove(old_key, old_value)
+
+    def get(self, key, default=None):
+        """
+        Get item and mark it as recently used
+        """
+        return self[key] if key in self._data else default
+
+    def peek(self, key, default=None):
+        """
+        Get item without changing its position in cache
+        """
+        return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def clear(self):
+        self._data.clear()
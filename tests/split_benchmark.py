@@ -0,0 +1,23 @@
+"""
+Benchmark of message splitting on multi-megabyte messages. Run from root directory of repository:
+python tests/split_benchmark.py
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from outgoing_queue import split_message
+
+
+def run(name, message, repeat=3):
+    best = min(timeit.repeat(lambda: sum(1 for _ in split_message(message)), number=1, repeat=repeat))
+    print '{}: {:.1f} MB, {:.3f} s, {:.1f} MB/s'.format(name, len(message) / 2. ** 20, best,
+                                                    len(message) / 2. ** 20 / best)
+
+
+if __name__ == '__main__':
+    for size in (1, 4, 16):
+        words = ('lorem ipsum dolor sit amet ' * (size * 2 ** 20 / 27)).encode('utf-8')
+        run('words', words)
+        run('no separators', 'x' * size * 2 ** 20)
+        run('cyrillic', (u'\u0416' * (size * 2 ** 19)).encode('utf-8'))
@@ -2,6 +2,22 @@ from src.bootstrap import node_generator
 from src.profile import *
 from src.settings import ProfileHelper
 from src.tox_dns import tox_dns
+from src.util import LRUCache
+from src.avatar_store import AvatarStore
+from src.contact_search import ContactSearchIndex
+from src.friends_import import parse_ids
+from src.outgoing_queue import OutgoingQueue, split_message
+from src.typing_notifications import TypingNotifications
+from src.flood_control import FloodControl, FLOOD_STATE
+from src.chat_view import ChatView
+from src.callbacks import EventBus
+from src.tox_commands import ToxCommands
+from src.scheduler import Histogram, ToxScheduler
+from src.calls import AV, CALL_TYPE
+import tempfile
+import shutil
+import random
+import time
 
 
 class TestProfile():
@@ -72,3 +88,298 @@ class TestDNS():
         bot_id = '56A1ADE4B65B86BCD51CC73E2CD4E542179F47959FE3E0E21B4B0ACDADE51855D34D34D37CB5'
         tox_id = tox_dns('groupbot@toxme.io')
         assert tox_id == bot_id
+
+
+class TestLRUCache():
+
+    def test_eviction(self):
+        removed = []
+        cache = LRUCache(2, lambda key, value: removed.append(key))
+        cache[1], cache[2] = 'a', 'b'
+        assert cache.get(1) == 'a'
+        cache[3] = 'c'
+        assert removed == [2]
+        assert 1 in cache and 3 in cache and 2 not in cache
+
+    def test_peek(self):
+        cache = LRUCache(2)
+        cache[1], cache[2] = 'a', 'b'
+        assert cache.peek(1) == 'a'
+        cache[3] = 'c'
+        assert 1 not in cache
+        assert cache.pop(2) == 'b'
+        assert len(cache) == 1
+
+
+class TestAvatarStore():
+
+    def test_reopen(self):
+        directory = tempfile.mkdtemp() + '/'
+        store = AvatarStore(directory)
+        store.set('A' * 64, 'data', 'B' * 64)
+        store.set('C' * 64, 'other', 'D' * 64)
+        store.remove('C' * 64)
+        store.close()
+        store = AvatarStore(directory)
+        assert store.get('A' * 64) == 'data'
+        assert store.get_hash('A' * 64) == 'B' * 64
+        assert 'C' * 64 not in store
+        store.close()
+
+
+class TestContactSearch():
+
+    def test_ranking(self):
+        index = ContactSearchIndex()
+        index.add(1, ['Alice Smith'], 'Toxing on toxygen', 'AB12' * 16)
+        index.add(2, ['Bob', 'Robert'], 'busy', 'FF00' * 16)
+        index.add(3, [u'Zo\xeb'], 'Alice fan', '1234' * 16)
+        assert index.search('alice') == [1, 3]
+        assert index.search('alise') == [1, 3]
+        assert index.search('rob') == [2]
+        assert index.search('zoe') == [3]
+        assert index.search('ab12') == [1]
+        index.remove(3)
+        assert index.search('zoe') == []
+
+    def test_speed(self):
+        rnd = random.Random(0)
+        syllables = ['al', 'ex', 'to', 'ma', 'ri', 'ko', 'na', 'sa', 'tom', 'ben', 'li', 'ox', 'ty', 'an', 'mi', 'ra',
+                     'da', 'vi', 'el', 'or', 'ju', 'ka', 'le', 'ne', 'pe', 'ro', 'si', 'te', 'un', 'wa']
+        statuses = ['Toxing on Toxygen'] * 6 + [''] * 2 + ['Toxing on qTox', None]  # most statuses are default
+        index = ContactSearchIndex()
+        for i in xrange(20000):
+            name = ''.join(rnd.choice(syllables) for _ in xrange(3)).capitalize()
+            status = rnd.choice(statuses)
+            if status is None:
+                status = ' '.join(''.join(rnd.choice(syllables) for _ in xrange(2)) for _ in xrange(3))
+            index.add(i, [name, ''], status, '%064X' % rnd.getrandbits(256))
+        index.add(20000, ['Toxic'], '', 'AB12' * 16)
+        start = time.time()
+        result = index.search('tox')
+        assert time.time() - start < 0.1
+        assert result[0] == 20000 and len(result) > 10000
+
+
+class TestFriendsImport():
+
+    def test_parse(self):
+        tox_id = '56A1ADE4B65B86BCD51CC73E2CD4E542179F47959FE3E0E21B4B0ACDADE51855D34D34D37CB5'
+        data = parse_ids('# friends\n\n{}\ngroupbot@toxme.io\n12345\n'.format(tox_id.lower()))
+        assert data == [(tox_id, None), ('groupbot@toxme.io', None), ('12345', 'Invalid TOX ID')]
+
+
+class TestHistory():
+
+    def setup_method(self, method):
+        storage = getattr(ProfileStorage, '_instance', None)
+        self.storage = None if storage is None else dict(storage.__dict__)  # singleton is re-initialized in test
+        self.directory = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        if self.storage is None:
+            del ProfileStorage._instance
+        else:
+            ProfileStorage.get_instance().__dict__.update(self.storage)
+        shutil.rmtree(self.directory)
+
+    def test_pending(self):
+        ProfileStorage(self.directory, 'test')
+        history = History('A' * 64)
+        first = history.add_pending('B' * 64, u'first', 0, 1.)
+        history.add_pending('B' * 64, u'second', 1, 2.)
+        history.add_pending('C' * 64, u'other', 0, 3.)
+        history.delete_pending(first)
+        assert history.get_pending('B' * 64) == [(first + 1, u'second', 1, 2.)]
+        history.delete_pending_messages('C' * 64)
+        assert history.get_pending('C' * 64) == []
+
+
+class TestOutgoingQueue():
+
+    def test_receipts(self):
+        class FakeTox(object):
+
+            def __init__(self):
+                self.online, self.sent = False, []
+
+            def friend_send_message(self, friend_number, message_type, message):
+                if not self.online:
+                    raise RuntimeError('This client is currently not connected to the friend.')
+                self.sent.append(message)
+                return len(self.sent) - 1
+
+        tox, events = FakeTox(), []
+        queue = OutgoingQueue()
+        queue.put(1, 0, ['a', 'b'], lambda: events.append('sent'), lambda: events.append('delivered'))
+        queue.drain(tox)
+        assert tox.sent == [] and not queue.is_empty(1)
+        tox.online = True
+        queue.drain(tox)
+        assert tox.sent == ['a', 'b'] and events == ['sent']
+        queue.receipt(1, 1)
+        queue.receipt(1, 0)
+        assert events == ['sent', 'delivered'] and queue.is_empty(1)
+
+
+class TestSplitMessage():
+
+    def test_properties(self):
+        random.seed(0)
+        alphabet = [u'a', u'b', u' ', u',', u'.', u'\n', u'\xe9', u'\u0416', u'\u6f22', u'\U0001f600']
+        for _ in xrange(200):
+            text = u''.join(random.choice(alphabet) for _ in xrange(random.randint(0, 5000)))
+            message = text.encode('utf-8')
+            size = random.randint(4, 1372)
+            chunks = list(split_message(message, size))
+            assert ''.join(chunks) == message
+            for chunk in chunks:
+                assert 0 < len(chunk) <= size
+                chunk.decode('utf-8')  # no character is split
+
+    def test_separators(self):
+        assert list(split_message('aaaa bbbb', 6)) == ['aaaa ', 'bbbb']
+        assert list(split_message('aaaaaaaa', 6)) == ['aaaaaa', 'aa']
+        assert list(split_message('')) == []
+
+
+class TestMessageItem():
+
+    def test_preview(self):
+        assert MessageItem.get_preview(u'short\nmessage') is None
+        text = u'\n'.join([u'line'] * 20)
+        assert MessageItem.get_preview(text) == u'\n'.join([u'line'] * 10) + u'...'
+        assert len(MessageItem.get_preview(u'x' * 5000)) == 1027
+
+
+class TestTypingNotifications():
+
+    def test_transitions(self):
+        class FakeTox(object):
+
+            def __init__(self):
+                self.sent = []
+
+            def self_set_typing(self, friend_number, typing):
+                self.sent.append((friend_number, typing))
+
+        tox, notifications = FakeTox(), TypingNotifications()
+        for _ in xrange(10):
+            notifications.keystroke(1)
+            notifications.update(tox)
+        assert tox.sent == [(1, True)]
+        notifications.stop(1)
+        notifications.update(tox)  # too early, state is sent later
+        assert tox.sent == [(1, True)]
+        notifications.remove(1)
+        notifications.update(tox)
+        assert tox.sent == [(1, True)]
+
+
+class TestFloodControl():
+
+    def test_rate(self):
+        flood_control = FloodControl()
+        states = [flood_control.check(1, 2, 4) for _ in xrange(6)]
+        assert states == [FLOOD_STATE['NORMAL']] * 2 + [FLOOD_STATE['THROTTLED']] * 2 + [FLOOD_STATE['MUTED']] * 2
+        assert flood_control.check(2, 2, 4) == FLOOD_STATE['NORMAL']
+        assert flood_control.put_message(1, 0, 'a')
+        assert not flood_control.put_message(2, 0, 'b', False)
+        assert flood_control.take_messages() == [(1, 0, 'a', True), (2, 0, 'b', False)]
+        assert flood_control.put_message(1, 0, 'c')
+
+    def test_muted_bottom(self):
+        view = ChatView(None)  # list widget is not used by counters
+        view.skip_newest(True)
+        view.skip_newest(False)  # file transfer during flood
+        assert view.is_bottom_muted() and view.newer == 2
+        view.newer = 0
+        view.skip_newest(False)  # user scrolled up, bottom of chat isn't rendered
+        view.skip_newest(True)
+        assert not view.is_bottom_muted()
+
+
+class TestEventBus():
+
+    def test_order(self):
+        bus, calls = EventBus(), []
+        bus.update('name', calls.append, ('a', ), {})
+        bus.invoke(calls.append, ('b', ), {})
+        bus.update('name', calls.append, ('c', ), {})
+        bus.update('status', calls.append, ('d', ), {})
+        bus.event(None)
+        assert calls == ['b', 'c', 'd']  # merged update is called at position of last one
+        assert bus.get_stats()['merged'] == 1
+
+    def test_next_batch(self):
+        bus, calls = EventBus(), []
+        bus.update('name', calls.append, ('a', ), {})
+        bus.event(None)
+        bus.update('name', calls.append, ('b', ), {})
+        bus.event(None)
+        assert calls == ['a', 'b']
+        bus.update('name', calls.append, ('c', ), {})
+        bus.clear()
+        bus.event(None)
+        assert calls == ['a', 'b']
+
+
+class TestToxCommands():
+
+    def test_execute(self):
+        commands, results = ToxCommands(), []
+        commands.call(lambda x: x * 2, 21).add_done_callback(lambda future: results.append(future.result()))
+        failed = commands.call(int, 'x')
+        assert not failed.done()
+        commands.execute()
+        assert commands.is_empty() and results == [42]
+        assert failed.done() and isinstance(failed.exception(), ValueError)
+
+
+class TestToxScheduler():
+
+    def test_shutdown(self):
+        class FakeToxAV(object):
+
+            def __init__(self):
+                self.iterations = 0
+
+            def iterate(self):
+                self.iterations += 1
+
+            def iteration_interval(self):
+                return 1
+
+        class FakeTox(object):
+
+            def __init__(self):
+                self.AV, self.iterations = FakeToxAV(), 0
+
+            def iterate(self):
+                self.iterations += 1
+                if self.iterations == 2:
+                    av.stop()  # profile is closed before scheduler is stopped
+                elif self.iterations == 3:
+                    scheduler.stop = True
+
+            def iteration_interval(self):
+                return 1
+
+        ToxCommands(), OutgoingQueue(), TypingNotifications()
+        tox = FakeTox()
+        av = AV(tox.AV)
+        av._calls[1] = CALL_TYPE['AUDIO']  # active call without audio devices
+        scheduler = ToxScheduler(tox, av)
+        scheduler.run()
+        assert tox.iterations == 3 and tox.AV.iterations == 1
+
+
+class TestHistogram():
+
+    def test_buckets(self):
+        histogram = Histogram(bounds=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.add(value)
+        data = histogram.get_data()
+        assert data['count'] == 4 and data['max'] == 50 and data['mean'] == 14.125
+        assert data['buckets'] == [(1, 2), (10, 1), (None, 1)]